@@ -0,0 +1,468 @@
+"""
+Benchmarks for the schedule search, on synthetic or recorded catalogs so they
+run offline.
+
+    python benchmark.py suite [--catalog FILE] [--out FILE]
+        time solving, enumerating, counting and ranking schedules for random
+        students, printing JSON results
+    python benchmark.py diff OLD NEW
+        compare two saved suite results
+    python benchmark.py record FILE YEAR SEASON SUBJ NUM [SUBJ NUM ...]
+        save the live sections of some classes as a catalog for --catalog
+    python benchmark.py engines
+        time the search engines against each other
+"""
+import argparse
+import json
+import random
+import sys
+import time
+import gc
+
+from objdict import ObjectDict
+import courses
+import solver
+import utils
+
+def legacyOneFromEach(lists, conflicts, stats):
+    """
+    utils.oneFromEach() as it was before solver.py, counting values tried in
+    stats.nodes, lists built in stats.lists and exceptions raised in
+    stats.raises.
+    """
+    def inner(lists, existing=[]):
+        if not lists:
+            return []
+        for e in lists[0]:
+            stats.nodes += 1
+            if not any(conflicts(e, exE) for exE in existing):
+                try:
+                    # lists[1:] and existing + [e], plus [e] + ... on success
+                    stats.lists += 2
+                    ans = [e] + inner(lists[1:], existing + [e])
+                    stats.lists += 1
+                except ValueError:
+                    pass
+                else:
+                    return ans
+        stats.raises += 1
+        raise ValueError('no solution')
+
+    try:
+        return inner(sorted(lists, key=len))
+    except ValueError:
+        return None
+
+def recursiveSolutions(domains, neighbors, stats):
+    """
+    solver.iterSolutions() as it was before it used an explicit stack:
+    recursive, with a new list of domains and new filtered domains built for
+    every node, counted in stats.lists.
+    """
+    adjacent = solver.clusterGraph(domains, neighbors)
+    assignment = [None] * len(domains)
+
+    def search(domains, unassigned):
+        if not unassigned:
+            yield
+            return
+
+        i = min(unassigned,
+                key=lambda i: (len(domains[i]), -len(adjacent[i] & unassigned)))
+        rest = unassigned - set([i])
+        affected = adjacent[i] & rest
+
+        for v in domains[i]:
+            stats.nodes += 1
+            nbrs = neighbors[v]
+            newDomains = list(domains)
+            stats.lists += 1
+            for j in affected:
+                newDomains[j] = [w for w in domains[j] if w not in nbrs]
+                stats.lists += 1
+                if not newDomains[j]:
+                    break
+            else:
+                assignment[i] = v
+                for _ in search(newDomains, rest):
+                    yield
+
+    for _ in search(list(domains), set(xrange(len(domains)))):
+        yield list(assignment)
+
+def randomSections(rng, numClusters, clusterSize):
+    """
+    Return `numClusters` lists of the intervals of `clusterSize` fake sections
+    with random meeting times on weekdays between 8 AM and 5 PM.
+    """
+    clusters = []
+    for c in xrange(numClusters):
+        secs = []
+        for s in xrange(clusterSize):
+            days = rng.choice(('MWF', 'TR', 'MW', 'M', 'T', 'W', 'R', 'F'))
+            hr = rng.randint(8, 16)
+            mins = rng.choice((0, 30))
+            length = rng.choice((50, 80, 110))
+            end = hr * 60 + mins + length
+            secs.append(courses.strToIntervals('%s %d:%02d %d:%02d' \
+                    % (days, hr, mins, end // 60, end % 60)))
+        clusters.append(secs)
+    return clusters
+
+def randomProblem(seed, numClusters, clusterSize):
+    """Return (domains, neighbors) for the solver from randomSections()."""
+    clusters = randomSections(random.Random(seed), numClusters, clusterSize)
+    sections = [sec for secs in clusters for sec in secs]
+    neighbors = courses.conflictGraph([[courses.intervalToSlots(ival)
+            for ival in sec] for sec in sections])
+    domains = []
+    i = 0
+    for secs in clusters:
+        domains.append(range(i, i + len(secs)))
+        i += len(secs)
+    return domains, neighbors
+
+def consume(solutions, limit):
+    """Step through up to `limit` of `solutions`, discarding them."""
+    for i, solution in enumerate(solutions):
+        if i + 1 >= limit:
+            break
+
+def timeEngine(run):
+    """Return (seconds, stats) for calling run(stats), with gc off."""
+    stats = ObjectDict(int)
+    gc.collect()
+    gc.disable()
+    try:
+        start = time.time()
+        run(stats)
+        return time.time() - start, stats
+    finally:
+        gc.enable()
+
+def compareEngines(seeds=xrange(20), numClusters=14, clusterSize=4,
+        enumLimit=20000):
+    """
+    Print nodes, time per node and allocations per node of the legacy
+    chronological search, the recursive forward-checking search and the
+    iterative solver on the same random problems: once finding the first
+    solution, where times include each engine's setup, and once enumerating
+    up to `enumLimit` solutions, where the search itself dominates.
+
+    Allocations are each engine's own count of the lists it builds during the
+    search, not including setup, which for the iterative solver are only the
+    solutions it returns. Instead of building filtered domains, it pushes
+    pruned values on a trail, counted in 'trail/node'.
+    """
+    def first(solutions):
+        for solution in solutions:
+            return solution
+
+    engines = (
+            ('legacy', lambda domains, neighbors, stats: legacyOneFromEach(
+                domains, lambda a, b: b in neighbors[a], stats)),
+            ('recurse', lambda domains, neighbors, stats: first(
+                recursiveSolutions(domains, neighbors, stats))),
+            ('solver', solver.solve),
+            ('recurse*', lambda domains, neighbors, stats: consume(
+                recursiveSolutions(domains, neighbors, stats), enumLimit)),
+            ('solver*', lambda domains, neighbors, stats: consume(
+                solver.iterSolutions(domains, neighbors, stats), enumLimit)),
+            )
+
+    totals = dict((name, [0.0, ObjectDict(int)]) for name, engine in engines)
+    for seed in seeds:
+        domains, neighbors = randomProblem(seed, numClusters, clusterSize)
+        for name, engine in engines:
+            secs, stats = timeEngine(
+                    lambda stats: engine(domains, neighbors, stats))
+            totals[name][0] += secs
+            for key, value in stats.iteritems():
+                totals[name][1][key] += value
+
+    print '* = enumerating up to %d solutions' % enumLimit
+    print '%-9s %10s %9s %9s %11s %11s %8s' % ('engine', 'nodes', 'seconds',
+            'us/node', 'lists/node', 'trail/node', 'raises')
+    for name, engine in engines:
+        secs, stats = totals[name]
+        nodes = max(stats.nodes, 1)
+        print '%-9s %10d %9.3f %9.2f %11.3f %11.2f %8d' % (name, stats.nodes,
+                secs, secs / nodes * 1e6, float(stats.lists) / nodes,
+                float(stats.trail) / nodes, stats.raises)
+
+def reprTime(minutes):
+    """
+    Return `minutes` after midnight in the format of the course site.
+
+    >>> reprTime(8 * 60), reprTime(13 * 60 + 50)
+    ('8:00 AM', '1:50 PM')
+    """
+    hr, mins = divmod(minutes, 60)
+    return '%d:%02d %s' % ((hr - 1) % 12 + 1, mins, 'PM' if hr >= 12 else 'AM')
+
+def syntheticCatalog(seed=0, numClasses=60, sectionsPerType=8,
+        types=('Lecture', 'Discussion'), startHour=8, endHour=17,
+        closedRate=0.2, year=2012, season='fall'):
+    """
+    Return a map of class -> sections, like getClassSections() returns, for
+    `numClasses` made up classes with `sectionsPerType` sections of each of
+    `types`, meeting at random times between `startHour` and `endHour`.
+    Narrowing the hours raises the conflict rate (see conflictRate()), and a
+    `closedRate` fraction of the sections are closed.
+    """
+    rng = random.Random(seed)
+    catalog = {}
+    for c in xrange(numClasses):
+        cls = ('SYN', 100 + c, year, season)
+        sections = catalog[cls] = []
+        for tp in types:
+            for s in xrange(sectionsPerType):
+                days, length = rng.choice((('MWF', 50), ('TR', 80), ('MW', 80),
+                        ('M', 110), ('T', 110), ('W', 110), ('R', 110)))
+                start = rng.randrange(startHour * 60,
+                        max(endHour * 60 - length, startHour * 60 + 1), 30)
+                sections.append({
+                        'CRN': str(10000 + 100 * c + len(sections)),
+                        'Type': tp,
+                        'Section': '%s%d' % (tp[0], s),
+                        'Time': '%s - %s' % (reprTime(start),
+                            reprTime(start + length)),
+                        'Days': days,
+                        'Status': 'closed' if rng.random() < closedRate else 'open',
+                        'Detail': '',
+                        'Instructor': '',
+                        'Location': '',
+                        })
+    return catalog
+
+def saveCatalog(catalog, path):
+    """Write a map of class -> sections to `path` as JSON."""
+    with open(path, 'w') as f:
+        json.dump(sorted(catalog.items()), f, indent=1, sort_keys=True)
+
+def loadCatalog(path):
+    """Return the map of class -> sections saved by saveCatalog()."""
+    with open(path) as f:
+        return dict((tuple(cls), sections) for cls, sections in json.load(f))
+
+def recordCatalog(classes, path):
+    """Fetch the live sections of `classes` and save them to `path`."""
+    saveCatalog(dict((tuple(cls), courses.getClassSections(*cls))
+            for cls in classes), path)
+
+def conflictRate(sectionsByClass):
+    """
+    Return the fraction of pairs of sections of different classes that
+    overlap, for a map like courses.loadSections() returns.
+    """
+    sections = [sec for secs in sectionsByClass.itervalues() for sec in secs]
+    neighbors = courses.conflictGraph([sec.slots for sec in sections])
+    pairs = len(sections) * (len(sections) - 1) // 2 \
+            - sum(len(secs) * (len(secs) - 1) // 2
+                for secs in sectionsByClass.itervalues())
+    conflicts = sum(1 for i, nbrs in enumerate(neighbors) for j in nbrs
+            if j > i and sections[i].cls != sections[j].cls)
+    return float(conflicts) / max(pairs, 1)
+
+def percentiles(values, ps=(50, 90, 99)):
+    """
+    Return a dict of the nearest-rank percentiles `ps` of `values`, plus their
+    mean and max.
+
+    >>> sorted(percentiles(range(1, 101)).items())
+    [('max', 100), ('mean', 50.5), ('p50', 50), ('p90', 90), ('p99', 99)]
+    """
+    values = sorted(values)
+    if not values:
+        return {}
+    out = {'mean': float(sum(values)) / len(values), 'max': values[-1]}
+    for p in ps:
+        out['p%d' % p] = values[max(-(-p * len(values) // 100) - 1, 0)]
+    return out
+
+def runSuite(catalog, seed=0, numQueries=50, classesPerQuery=5,
+        enumLimit=1000, k=5, maxNodes=200000):
+    """
+    Return JSON-ready results for planning schedules for `numQueries` random
+    students, each taking `classesPerQuery` classes of `catalog` (a map of
+    class -> sections, as from syntheticCatalog() or loadCatalog()).
+
+    Each operation is timed per student, and its seconds and nodes are
+    summarized with percentiles():
+        plan        courses.planSchedule(), including grouping the sections
+                    and building the conflict graph
+        oneFromEach utils.oneFromEach() over the same groups
+        solve       solver.solve() alone
+        enumerate   solver.iterSolutions(), up to `enumLimit` solutions
+        count       solver.countSolutions()
+        best        solver.bestSolutions() for the `k` best
+
+    Searches give up after `maxNodes`, counted in 'budgetExceeded'. Students
+    with no possible schedule are counted in 'infeasible', and only timed if
+    that takes a search.
+    """
+    sectionsByClass = dict((cls, courses.normalizeSections(cls, sections))
+            for cls, sections in catalog.iteritems())
+    rng = random.Random(seed)
+    classes = sorted(sectionsByClass)
+    score, bound = courses.scheduleObjective()
+
+    def solve(query, groups, clusters, neighbors, stats):
+        solution = solver.solve(clusters, neighbors, stats, maxNodes=maxNodes)
+        stats.solutions += solution is not None
+
+    def plan(query, groups, clusters, neighbors, stats):
+        try:
+            return courses.planSchedule(query, stats=stats, nodeLimit=maxNodes,
+                    sectionsByClass=sectionsByClass)
+        except Exception:
+            # no schedule possible, or out of budget, which stats records
+            return None
+
+    operations = (
+            ('plan', plan),
+            ('oneFromEach', lambda query, groups, clusters, neighbors, stats:
+                utils.oneFromEach([[groups[g][0] for g in cluster]
+                        for cluster in clusters],
+                    lambda a, b: a.mask & b.mask, stats)),
+            ('solve', solve),
+            ('enumerate', lambda query, groups, clusters, neighbors, stats:
+                consume(solver.iterSolutions(clusters, neighbors, stats,
+                    maxNodes=maxNodes), enumLimit)),
+            ('count', lambda query, groups, clusters, neighbors, stats:
+                solver.countSolutions(clusters, neighbors, stats=stats,
+                    maxNodes=maxNodes)),
+            ('best', lambda query, groups, clusters, neighbors, stats:
+                solver.bestSolutions(clusters, neighbors,
+                    [group[0].mask for group in groups], score, bound, k,
+                    stats, maxNodes=maxNodes)),
+            )
+
+    samples = dict((name, ([], [], [0])) for name, op in operations)
+    infeasible = 0
+    for q in xrange(numQueries):
+        query = rng.sample(classes, min(classesPerQuery, len(classes)))
+        try:
+            groups, clusters, neighbors = courses.buildClusters(query,
+                    sectionsByClass=sectionsByClass)
+        except Exception:
+            infeasible += 1
+            continue
+
+        for name, op in operations:
+            secs, stats = timeEngine(lambda stats: op(query, groups, clusters,
+                    neighbors, stats))
+            seconds, nodes, exceeded = samples[name]
+            seconds.append(secs)
+            nodes.append(stats.nodes)
+            exceeded[0] += stats.budgetExceeded
+            if name == 'solve' and not stats.solutions \
+                    and not stats.budgetExceeded:
+                infeasible += 1
+
+    return {
+            'queries': numQueries,
+            'classesPerQuery': classesPerQuery,
+            'infeasible': infeasible,
+            'catalog': {
+                'classes': len(classes),
+                'sections': sum(len(secs) for secs in catalog.itervalues()),
+                'conflictRate': round(conflictRate(sectionsByClass), 4),
+                },
+            'operations': dict((name, {
+                    'seconds': percentiles(seconds),
+                    'nodes': percentiles(nodes),
+                    'budgetExceeded': exceeded[0],
+                    }) for name, (seconds, nodes, exceeded)
+                        in samples.iteritems()),
+            }
+
+def diffResults(old, new, stat='p50'):
+    """
+    Print the `stat` percentile of seconds and nodes per operation for two
+    runSuite() results, with new / old ratios.
+    """
+    print '%-12s %10s %10s %7s %10s %10s %7s' % ('operation', 'old s',
+            'new s', 'ratio', 'old nodes', 'new nodes', 'ratio')
+    for name in sorted(set(old['operations']) | set(new['operations'])):
+        row = [name]
+        for field in ('seconds', 'nodes'):
+            a = old['operations'].get(name, {}).get(field, {}).get(stat)
+            b = new['operations'].get(name, {}).get(field, {}).get(stat)
+            row += [a, b, float(b) / a if a and b is not None else None]
+        print '%-12s %10s %10s %7s %10s %10s %7s' % tuple(
+                '-' if v is None else '%.4g' % v if isinstance(v, float) else v
+                for v in row)
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+            description='Benchmark the schedule search offline.')
+    commands = parser.add_subparsers(dest='command')
+
+    suite = commands.add_parser('suite',
+            help='time schedule operations for random students')
+    suite.add_argument('--catalog', help='catalog saved by record, instead of '
+            'a synthetic one')
+    suite.add_argument('--out', help='also write the JSON results here')
+    suite.add_argument('--seed', type=int, default=0)
+    suite.add_argument('--queries', type=int, default=50)
+    suite.add_argument('--classes-per-query', type=int, default=5)
+    suite.add_argument('--enum-limit', type=int, default=1000)
+    suite.add_argument('--max-nodes', type=int, default=200000)
+    suite.add_argument('--num-classes', type=int, default=60,
+            help='synthetic catalog size')
+    suite.add_argument('--sections-per-type', type=int, default=8,
+            help='synthetic catalog density')
+    suite.add_argument('--hours', type=int, nargs=2, default=(8, 17),
+            metavar=('START', 'END'), help='synthetic meeting hours; fewer '
+            'hours means more conflicts')
+    suite.add_argument('--closed-rate', type=float, default=0.2)
+
+    diff = commands.add_parser('diff', help='compare two suite results')
+    diff.add_argument('old')
+    diff.add_argument('new')
+    diff.add_argument('--stat', default='p50')
+
+    record = commands.add_parser('record',
+            help='save live sections as a catalog')
+    record.add_argument('path')
+    record.add_argument('year', type=int)
+    record.add_argument('season')
+    record.add_argument('classes', nargs='+', metavar='SUBJ NUM')
+
+    commands.add_parser('engines', help='compare the search engines')
+
+    args = parser.parse_args(argv)
+    if args.command == 'suite':
+        if args.catalog:
+            catalog = loadCatalog(args.catalog)
+        else:
+            catalog = syntheticCatalog(args.seed, args.num_classes,
+                    args.sections_per_type, startHour=args.hours[0],
+                    endHour=args.hours[1], closedRate=args.closed_rate)
+        results = runSuite(catalog, args.seed, args.queries,
+                args.classes_per_query, args.enum_limit,
+                maxNodes=args.max_nodes)
+        results['source'] = args.catalog or 'synthetic'
+        out = json.dumps(results, indent=1, sort_keys=True)
+        print out
+        if args.out:
+            with open(args.out, 'w') as f:
+                f.write(out + '\n')
+    elif args.command == 'diff':
+        with open(args.old) as f:
+            old = json.load(f)
+        with open(args.new) as f:
+            new = json.load(f)
+        diffResults(old, new, args.stat)
+    elif args.command == 'record':
+        if len(args.classes) % 2:
+            parser.error('classes are SUBJ NUM pairs')
+        recordCatalog([(subCode, int(num), args.year, args.season)
+                for subCode, num in zip(args.classes[::2], args.classes[1::2])],
+                args.path)
+    else:
+        compareEngines()
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -3,15 +3,81 @@ import urllib2
 import re
 from bs4 import BeautifulSoup
 import itertools
-from collections import defaultdict
+from collections import defaultdict, namedtuple
 import logging
+import time
+import hashlib
 
 from decorators import retry
+from objdict import ObjectDict
 import utils
 import misc
+import solver
 
 DAYS = 'mtwrf'
 
+# Resolution of the week bitmasks used for conflict checks.
+SLOT_MINS = 5
+SLOTS_PER_DAY = 24 * 60 // SLOT_MINS
+DAY_MASK = (1 << SLOTS_PER_DAY) - 1
+
+# Bumped by newCatalog() whenever a new list of classes is installed, so cached
+# results from the old one are never used.
+catalogVersion = 0
+# Seconds a class's sections, and schedules planned from them, are used before
+# being fetched or planned again, since open/closed status changes during the
+# day, and seconds before sections are too old to use at all, which should
+# outlast the nightly crawl.
+SECTIONS_FRESH_TTL = 10 * 60
+SECTIONS_TTL = 36 * 60 * 60
+# planSchedule() results, keyed by requestKey(), for as long as the sections
+# they're planned from are fresh
+resultCache = utils.LRUCache(1000, ttl=SECTIONS_FRESH_TTL)
+# Rows of each class's sections with the time they were fetched, shared by every
+# instance, so the ones crawlSections() puts there serve requests wherever they
+# run: any object with get(key) and set(key, value, time) like App Engine's
+# memcache module, which main.py installs. With None, sections are only kept
+# in this process.
+sharedRows = None
+# (subCode, num, year, season) -> Sections of every class in the catalog, kept
+# in front of sharedRows, so requests don't wait on the course site. Since the
+# shared rows are also used while fresh, sections are at most twice
+# SECTIONS_FRESH_TTL old before being fetched again.
+sectionStore = utils.TTLCache(lambda cls: getSections(*cls),
+        SECTIONS_FRESH_TTL, SECTIONS_TTL, limit=50000)
+
+class BudgetExceeded(Exception):
+    """Raised when a schedule search runs out of its time or node budget."""
+    pass
+
+class Section(namedtuple('Section',
+        'cls crn type isOpen intervals slots mask row alternates')):
+    """
+    A section of class `cls`, made once from its row of the class's table by
+    normalizeSections() and shared by every request, so it is immutable and
+    requests never parse the row's strings.
+
+    `crn` is an int and `type` an interned string. `intervals` are its
+    meeting times as a tuple of intervals, empty if it has none, such as an
+    online section, `slots` the same as intervalToSlots() tuples and `mask`
+    their week bitmask, for conflict checks. `row` is the table row itself,
+    which must not be modified either. expandSchedule() gives chosen sections
+    the CRNs of equivalent ones as `alternates`, which is otherwise empty.
+    """
+    __slots__ = ()
+
+# one copy of each string internString() has seen
+_strings = {}
+
+def internString(s):
+    """
+    Same as intern(), but also for unicode, which table rows hold.
+
+    >>> internString(u'Lecture') is internString(u'Lec' + u'ture')
+    True
+    """
+    return _strings.setdefault(s, s)
+
 def extractTableData(soup):
     """From soup of course page HTML, return a list of table rows."""
     for selector in ('table#table-alt-b', 'table.tablesorter', 'table.tableitems', 'table'):
@@ -40,10 +106,29 @@ def extractTableData(soup):
 
     return secList
 
-def urlopenPath(path):
+# the course site's pages, and what was parsed from them, so a page that is
+# unchanged, by a 304 or the SHA-1 of its body, isn't parsed again
+pageCache = utils.PageCache()
+
+def pathURL(path):
     if not path.startswith('/'):
         path = '/' + path
-    return utils.urlopenUA('https://courses.illinois.edu/cisapp/dispatcher' + path)
+    return 'https://courses.illinois.edu/cisapp/dispatcher' + path
+
+def urlopenPath(path):
+    """Return the response for the page at `path`, bypassing pageCache."""
+    return utils.urlopenUA(pathURL(path))
+
+def parsePath(path, parser):
+    """
+    Return parser(html) for the page at `path`. Unless the page changed since
+    the last time, neither the page is downloaded nor the html parsed again
+    (see utils.PageCache), and the result is shared, so it must not be
+    modified.
+    """
+    url = pathURL(path)
+    pageCache.fetch(url)
+    return pageCache.parse(url, parser)
 
 @retry(Exception)
 def getSubCodes(year, season):
@@ -66,21 +151,136 @@ def getCurYearSeason():
                     return (int(year), season)
     return None
 
-@retry(Exception)
-def getClassSections(subCode, num, year, season):
-    html = urlopenPath('schedule/%d/%s/%s/%d' \
-            % (year, season.lower(), subCode.upper(), num)).read()
+def parseSections(html):
     # work around malformed html that BeautifulSoup can't parse correctly (but
     # browsers can?!)
     html = html.replace('class="section-meeting"/>', 'class="section-meeting">')
     return extractTableData(BeautifulSoup(html))
 
+def sectionsPath(subCode, num, year, season):
+    return 'schedule/%d/%s/%s/%d' % (year, season.lower(), subCode.upper(), num)
+
 @retry(Exception)
-def getClasses(subCode, year, season):
-    html = urlopenPath('schedule/%d/%s/%s' \
-            % (year, season.lower(), subCode.upper())).read()
+def getClassSections(subCode, num, year, season):
+    return parsePath(sectionsPath(subCode, num, year, season), parseSections)
+
+@retry(Exception)
+def getSectionsPage(subCode, num, year, season):
+    """
+    Fetch a class's sections page into pageCache for parseSections(), and
+    return whether it changed, or None if it couldn't be fetched.
+    """
+    return pageCache.fetch(pathURL(sectionsPath(subCode, num, year, season)))
+
+def sharedKey(subCode, num, year, season):
+    """Return the sharedRows key of a class's rows."""
+    return ('sections/%s/%d/%d/%s'
+            % (subCode.upper(), num, year, season.lower())).encode('utf-8')
+
+def shareRows(cls, rows):
+    """Put the rows of a class's sections in sharedRows, if there is one."""
+    if sharedRows is not None:
+        sharedRows.set(sharedKey(*cls), (rows, time.time()), time=SECTIONS_TTL)
+
+def getSections(subCode, num, year, season):
+    """
+    Return normalizeSections() of the class's rows from sharedRows if they're
+    newer than SECTIONS_FRESH_TTL, and otherwise of getClassSections(), which
+    are then shared. If they can't be fetched, older shared rows are used, and
+    without any, None is returned.
+    """
+    cls = (subCode, num, year, season)
+    entry = sharedRows.get(sharedKey(*cls)) if sharedRows is not None else None
+    if entry is not None and time.time() - entry[1] < SECTIONS_FRESH_TTL:
+        return normalizeSections(cls, entry[0])
+    rows = getClassSections(*cls)
+    if rows is None:
+        return normalizeSections(cls, entry[0]) if entry is not None else None
+    shareRows(cls, rows)
+    return normalizeSections(cls, rows)
+
+def storedSections(subCode, num, year, season):
+    """
+    Return the Sections of a class from sectionStore, which fetches them
+    live if it doesn't have them, or None if they can't be fetched. Sections
+    older than SECTIONS_FRESH_TTL are returned while newer ones are fetched.
+    """
+    return sectionStore.get((subCode, num, year, season))
+
+def classesPath(subCode, year, season):
+    return 'schedule/%d/%s/%s' % (year, season.lower(), subCode.upper())
+
+@retry(Exception)
+def getClassesPage(subCode, year, season):
+    """Same as getSectionsPage(), for a subject's classes page."""
+    return pageCache.fetch(pathURL(classesPath(subCode, year, season)))
+
+def parseClasses(html):
     return extractTableData(BeautifulSoup(html))
 
+@retry(Exception)
+def getClasses(subCode, year, season):
+    return parsePath(classesPath(subCode, year, season), parseClasses)
+
+def crawlClasses(subCodes, year, season, workers=8, timings=None):
+    """
+    Return (classes, failed): the getClasses() rows of all `subCodes`, and the
+    subject codes whose page couldn't be fetched or parsed.
+
+    Up to `workers` pages are downloaded at a time in threads, and each is
+    parsed here as soon as it arrives. If given, `timings` (a dict) gets
+    subCode -> (fetch seconds, parse seconds) for each subject.
+    """
+    classes = []
+    failed = []
+    for subCode, changed, err, fetchSecs in utils.imapThreaded(
+            lambda subCode: getClassesPage(subCode, year, season), subCodes,
+            workers):
+        start = time.time()
+        if changed is None:
+            # getClassesPage() gives None once its retries run out
+            logging.warning('could not fetch classes of %s: %s', subCode,
+                    err or 'out of retries')
+            failed.append(subCode)
+            continue
+        try:
+            # parsed here rather than by getClassesPage(), so pages keep
+            # downloading meanwhile, and skipped if the page hasn't changed
+            classes += pageCache.parse(
+                    pathURL(classesPath(subCode, year, season)), parseClasses)
+        except Exception as err:
+            logging.warning('could not parse classes of %s: %s', subCode, err)
+            failed.append(subCode)
+        if timings is not None:
+            timings[subCode] = (fetchSecs, time.time() - start)
+    return classes, failed
+
+def crawlSections(classes, workers=8, timings=None):
+    """
+    Fetch the sections of all `classes` (tuples of getClassSections()
+    arguments) like crawlClasses() does, and put them in sharedRows and
+    sectionStore. Classes whose sections can't be fetched or parsed keep the
+    ones stored before, if any, and are returned.
+    """
+    failed = []
+    for cls, changed, err, fetchSecs in utils.imapThreaded(
+            lambda cls: getSectionsPage(*cls), classes, workers):
+        start = time.time()
+        try:
+            if changed is None:
+                raise err or Exception('out of retries')
+            rows = pageCache.parse(pathURL(sectionsPath(*cls)), parseSections)
+            sections = normalizeSections(cls, rows)
+            shareRows(cls, rows)
+            sectionStore[cls] = sections
+        except Exception as err:
+            logging.warning('could not get sections of %s: %s', cls, err)
+            failed.append(cls)
+            continue
+        if timings is not None:
+            timings[cls] = (fetchSecs, time.time() - start)
+    return failed
+
 def overlaps(t1, t2):
     """
     >>> overlaps((1, 11, 00, 11, 50), (1, 10, 00, 10, 50))
@@ -122,6 +322,109 @@ def strToIntervals(s):
                 + getTimeTup(endTime))
     return ivals
 
+def intervalToSlots(ival):
+    """
+    Return (day index, first slot, last slot) for a 5-tuple interval. Both
+    slots are inclusive, so intervals that touch at an endpoint share a slot
+    like they do in overlaps().
+
+    >>> intervalToSlots((1, 10, 00, 10, 50))
+    (1, 120, 130)
+    """
+    return (ival[0],
+            (ival[1] * 60 + ival[2]) // SLOT_MINS,
+            (ival[3] * 60 + ival[4]) // SLOT_MINS)
+
+def intervalsToMask(ivals):
+    """
+    Return an int with one bit set for every slot of the week covered by
+    `ivals`, so two interval lists overlap iff their masks have a bit in
+    common. An interval that ends before it starts, such as a banned 5 PM to
+    9 AM, covers the start and the end of its day.
+
+    >>> intervalsToMask([(0, 0, 0, 0, 10)])
+    7
+    >>> m = intervalsToMask(strToIntervals('MW 11 11:50'))
+    >>> bool(m & intervalsToMask(strToIntervals('W 10 10:50')))
+    False
+    >>> bool(m & intervalsToMask(strToIntervals('W 10 11')))
+    True
+    >>> night = intervalsToMask([(0, 17, 0, 9, 0)])
+    >>> night == intervalsToMask([(0, 0, 0, 9, 0), (0, 17, 0, 23, 59)])
+    True
+    >>> bool(night & intervalsToMask(strToIntervals('M 9:30 16:50')))
+    False
+    """
+    mask = 0
+    for ival in ivals:
+        day, first, last = intervalToSlots(ival)
+        if last < first:
+            mask |= DAY_MASK >> (SLOTS_PER_DAY - last - 1) << (day * SLOTS_PER_DAY)
+            last = SLOTS_PER_DAY - 1
+        mask |= ((1 << (last - first + 1)) - 1) << (day * SLOTS_PER_DAY + first)
+    return mask
+
+def dayMasks(mask):
+    """Split a week mask into one mask per day, with bit 0 at midnight."""
+    return [(mask >> (day * SLOTS_PER_DAY)) & DAY_MASK for day in xrange(len(DAYS))]
+
+def daysOnCampus(mask):
+    """
+    >>> daysOnCampus(intervalsToMask(strToIntervals('MWF 10 10:50')))
+    3
+    """
+    return sum(1 for m in dayMasks(mask) if m)
+
+def gapMinutes(mask, fillable=0):
+    """
+    Return the total minutes between the first and last class of each day that
+    are not spent in class, leaving out any slots set in `fillable`.
+
+    >>> m = intervalsToMask(strToIntervals('M 10 10:50 13 13:50'))
+    >>> gapMinutes(m)
+    125
+    >>> gapMinutes(m, intervalsToMask(strToIntervals('M 11 11:50')))
+    70
+    """
+    slots = 0
+    for m, f in zip(dayMasks(mask), dayMasks(fillable)):
+        if m:
+            first = (m & -m).bit_length() - 1
+            span = ((1 << m.bit_length()) - 1) ^ ((1 << first) - 1)
+            slots += bin(span & ~m & ~f).count('1')
+    return slots * SLOT_MINS
+
+def earlyMinutes(mask, start=12 * 60):
+    """
+    Return the total minutes by which each day's first class starts before
+    `start` (minutes after midnight).
+
+    >>> earlyMinutes(intervalsToMask(strToIntervals('MW 10 10:50')))
+    240
+    """
+    mins = 0
+    for m in dayMasks(mask):
+        if m:
+            mins += max(0, start - ((m & -m).bit_length() - 1) * SLOT_MINS)
+    return mins
+
+def scheduleObjective(gaps=1, days=60, early=1):
+    """
+    Return (score, bound) functions of week masks for bestSchedules(). The
+    score is a weighted sum of gapMinutes(), daysOnCampus() and earlyMinutes(),
+    lower being better.
+
+    Adding classes never decreases the days or early terms, and can only fill
+    gaps with slots the remaining sections might use, so the bound counts the
+    gaps no remaining section can fill.
+    """
+    def bound(sure, maybe):
+        return days * daysOnCampus(sure) + early * earlyMinutes(sure) \
+                + gaps * gapMinutes(sure, maybe)
+    def score(mask):
+        return bound(mask, 0)
+    return score, bound
+
 def reprInterval(ival):
     def reprTime(t):
         return '%02d:%02d %s' \
@@ -130,14 +433,76 @@ def reprInterval(ival):
             % (DAYS[ival[0]].upper(), reprTime(ival[1:3]), reprTime(ival[3:5]))
 
 def sectionToIntervals(section):
+    """
+    Return the intervals a section's row meets at on weekdays, which are none
+    for sections without a meeting time, such as ARRANGED or online ones.
+
+    >>> sectionToIntervals({'Time': '01:00 PM - 01:50 PM', 'Days': 'TR'})
+    [(1, 13, 0, 13, 50), (3, 13, 0, 13, 50)]
+    >>> sectionToIntervals({'Time': 'ARRANGED', 'Days': 'n.a.'})
+    []
+    """
     def getHrMin(t):
         if t[2].lower() == 'pm' and int(t[0]) < 12:
             return (int(t[0]) + 12, int(t[1]))
         else:
             return (int(t[0]), int(t[1]))
-    t1, t2 = re.findall(r'\b(\d{1,2}):(\d{2})\s*(AM|PM)\b', section['Time'], flags=re.I)
+    times = re.findall(r'\b(\d{1,2}):(\d{2})\s*(AM|PM)\b', section['Time'], flags=re.I)
+    if len(times) != 2:
+        return []
+    t1, t2 = times
     return [(DAYS.index(day.lower()),) + getHrMin(t1) + getHrMin(t2) \
-                for day in section['Days']]
+                for day in section['Days'] if day.lower() in DAYS]
+
+def conflictGraph(slotLists, stats=None):
+    """
+    Return a list of sets, where the i-th set holds the indices of the lists of
+    intervalToSlots() tuples that overlap slotLists[i], such as the sections'
+    slots.
+
+    Built with a sweep over each day's intervals sorted by start slot, so only
+    intervals that are still running when another one starts get compared.
+    If given, `stats` (an ObjectDict(int)) gets the number of interval pairs
+    examined in `pairs`, and the number a pairwise check would examine in
+    `naivePairs`.
+
+    >>> slots = [[intervalToSlots(ival) for ival in strToIntervals(s)]
+    ...         for s in ('MW 10 10:50', 'W 10:30 11:20', 'MF 11 11:50')]
+    >>> stats = ObjectDict(int)
+    >>> conflictGraph(slots, stats)
+    [set([1]), set([0]), set([])]
+    >>> stats.pairs, stats.naivePairs
+    (1, 8)
+    """
+    if stats is None:
+        stats = ObjectDict(int)
+
+    events = []
+    for i, slots in enumerate(slotLists):
+        for slot in slots:
+            events.append(slot + (i,))
+    events.sort()
+
+    total = len(events)
+    stats.naivePairs += (total * total \
+            - sum(len(slots) ** 2 for slots in slotLists)) // 2
+
+    neighbors = [set() for slots in slotLists]
+    curDay = None
+    # (last slot, section index) of intervals that may still overlap
+    active = []
+    for day, first, last, i in events:
+        if day != curDay:
+            curDay = day
+            active = []
+        active = [(l, j) for l, j in active if l >= first]
+        for l, j in active:
+            stats.pairs += 1
+            if j != i:
+                neighbors[i].add(j)
+                neighbors[j].add(i)
+        active.append((last, i))
+    return neighbors
 
 def categorize(elems, key):
     """Return mapping of `key(e)` -> `list of elems` for e in elems."""
@@ -146,7 +511,212 @@ def categorize(elems, key):
         d[key(e)].append(e)
     return d
 
-def planSchedule(classes, badIvals=(), curCRNs=(), verbose=False):
+def printer(verbose):
+    """Return a print function that does nothing unless `verbose`."""
+    def printV(*args):
+        if verbose:
+            print ' '.join(str(a) for a in args)
+    return printV
+
+def normalizeSections(cls, rows):
+    """
+    Return a tuple of Sections of `cls` for the table `rows` that
+    getClassSections() returns.
+    """
+    sections = []
+    for row in rows:
+        intervals = tuple(sectionToIntervals(row))
+        sections.append(Section(cls, int(row['CRN']), internString(row['Type']),
+                'closed' not in row['Status'], intervals,
+                tuple(intervalToSlots(ival) for ival in intervals),
+                intervalsToMask(intervals), row, ()))
+    return tuple(sections)
+
+def fetchSections(classes, workers=8):
+    """
+    Lazily yield (class, sections) for the `classes` as storedSections() gets
+    them, first the ones already stored, then the others as up to `workers`
+    threads at a time fetch them.
+
+    The first class whose sections can't be fetched raises, and fetches that
+    haven't started yet are dropped.
+    """
+    def checked(cls, sections):
+        if sections is None:
+            raise Exception('Could not get sections of %s' % str(cls))
+        return cls, sections
+
+    missing = []
+    for cls in classes:
+        if cls in sectionStore:
+            # which may still load them, if they expired since the check
+            yield checked(cls, sectionStore.get(cls))
+        else:
+            missing.append(cls)
+
+    results = utils.imapThreaded(lambda cls: storedSections(*cls), missing,
+            workers)
+    try:
+        for cls, sections, err, secs in results:
+            if err is not None:
+                raise err
+            yield checked(cls, sections)
+    finally:
+        results.close()
+
+def loadSections(classes, verbose=False, workers=8):
+    """
+    Return a map of class -> Sections for the distinct `classes`, fetching
+    each class once, up to `workers` at a time. A class whose sections
+    couldn't be fetched maps to the exception instead.
+    """
+    printV = printer(verbose)
+    distinct = sorted(set(tuple(cls) for cls in classes))
+    sectionsByClass = {}
+    printV('finding sections for', len(distinct), 'classes')
+    for cls, sections, err, secs in utils.imapThreaded(
+            lambda cls: storedSections(*cls), distinct, workers):
+        if err is None and sections is None:
+            err = Exception('Could not get sections of %s' % str(cls))
+        sectionsByClass[cls] = err if err is not None else sections
+    printV('done')
+    return sectionsByClass
+
+def buildClusters(classes, badIvals=(), curCRNs=(), verbose=False, stats=None,
+        lockCRNs=(), sectionsByClass=None):
+    """
+    Fetch the sections of `classes` and return (groups, clusters, neighbors)
+    for the solver: `groups` is a list of lists of interchangeable sections,
+    `clusters` holds one list of indices into `groups` per (class, section
+    type), and `neighbors` is the conflict graph over `groups`.
+
+    The sections are taken from `sectionsByClass`, as loadSections() returns,
+    instead of fetched, if given. See planSchedule() for the other arguments.
+    """
+    printV = printer(verbose)
+    if stats is None:
+        stats = ObjectDict(int)
+
+    badMask = intervalsToMask(badIvals)
+    lockCRNs = set(int(crn) for crn in lockCRNs)
+
+    # the distinct classes, and where each is in `classes`
+    distinct = []
+    positions = defaultdict(list)
+    for i, cls in enumerate(classes):
+        if cls not in positions:
+            distinct.append(cls)
+        positions[cls].append(i)
+
+    # Contains lists of mutually exclusive section groups - a schedule is made
+    # by selecting one item out of each list. Each group holds sections of the
+    # same type that meet at the same times and are all open or all closed, so
+    # the search only branches once per distinct time slot. They are built as
+    # each class's sections arrive, but kept in the order of `classes` so the
+    # search doesn't depend on which fetch finished first.
+    clsClusters = [None] * len(classes)
+    # (class, section type) of each cluster, for error messages
+    clsClusterNames = [None] * len(classes)
+
+    if sectionsByClass is not None:
+        arrivals = ((cls, sectionsByClass[cls]) for cls in distinct)
+    else:
+        printV('finding sections for', len(distinct), 'classes')
+        arrivals = fetchSections(distinct)
+
+    try:
+        for cls, sections in arrivals:
+            if isinstance(sections, Exception):
+                raise sections
+
+            tpToSecList = categorize(sections, key=lambda sec: sec.type)
+
+            # filter each section list by if closed and if overlap with
+            # badIvals, except that a locked section is the only option for its
+            # type
+            for tp, secs in tpToSecList.iteritems():
+                locked = [sec for sec in secs if sec.crn in lockCRNs]
+                if locked:
+                    tpToSecList[tp] = locked
+                    continue
+                tpToSecList[tp] = [sec for sec in secs \
+                        if not sec.mask & badMask \
+                            and (sec.isOpen or sec.crn in curCRNs)]
+
+            # check for any categories with no sections open
+            for tp, secs in tpToSecList.iteritems():
+                if not secs:
+                    raise Exception('No sections available for %s, %s' \
+                            % (str(cls), tp))
+
+            secClusters = []
+            clusterNames = []
+            for tp, secs in tpToSecList.iteritems():
+                groups = categorize(secs, key=lambda sec: \
+                        (sec.intervals, not sec.isOpen))
+                secClusters.append(groups.values())
+                clusterNames.append((cls, tp))
+            for i in positions[cls]:
+                clsClusters[i] = secClusters
+                clsClusterNames[i] = clusterNames
+    finally:
+        # stop fetching after a failure
+        arrivals.close()
+    printV('done')
+
+    secClusters = [groups for secClusters in clsClusters for groups in secClusters]
+    clusterNames = [name for names in clsClusterNames for name in names]
+
+    printV('building conflict graph')
+    # the search works on indices into this list of groups
+    candidates = [group for groups in secClusters for group in groups]
+    neighbors = conflictGraph([group[0].slots for group in candidates], stats)
+    idxClusters = []
+    i = 0
+    for groups in secClusters:
+        idxClusters.append(range(i, i + len(groups)))
+        i += len(groups)
+    stats.sections += sum(len(group) for group in candidates)
+    stats.groups += len(candidates)
+    printV('grouped', stats.sections, 'sections into', stats.groups, 'time slots')
+    printV('examined', stats.pairs, 'of', stats.naivePairs, 'interval pairs')
+
+    # drop groups that conflict with every option of some other cluster, which
+    # also removes everything conflicting with a locked section
+    idxClusters = solver.reduceDomains(idxClusters, neighbors, stats)
+    printV('pruned', stats.pruned, 'of', len(candidates), 'time slots')
+    for (cls, tp), idxs in zip(clusterNames, idxClusters):
+        if not idxs:
+            raise Exception('No sections available for %s, %s' \
+                    % (str(cls), tp))
+
+    return candidates, idxClusters, neighbors
+
+def expandSchedule(groups, chosen, curCRNs=()):
+    """
+    Return a map of `class` -> `list of sections to take` for the indices into
+    `groups` picked by the solver.
+
+    Each chosen group is expanded into one concrete section, preferring one
+    whose CRN is in `curCRNs`; the CRNs of the equivalent sections are its
+    `alternates`.
+    """
+    sectionsToTake = []
+    for i in chosen:
+        group = sorted(groups[i], key=lambda sec: sec.crn not in curCRNs)
+        sectionsToTake.append(group[0]._replace(
+                alternates=tuple(alt.crn for alt in group[1:])))
+
+    return categorize(sectionsToTake, key=lambda sec: sec.cls)
+
+def searchLimits(timeLimit, nodeLimit):
+    """Return solver (deadline, maxNodes) for a search starting now."""
+    return (time.time() + timeLimit if timeLimit is not None else None,
+            nodeLimit)
+
+def planSchedule(classes, badIvals=(), curCRNs=(), verbose=False, stats=None,
+        timeLimit=None, nodeLimit=None, processes=None, prevCRNs=(),
+        lockCRNs=(), sectionsByClass=None):
     """
     Return a map of `class` -> `list of sections to take`.
 
@@ -155,58 +725,271 @@ def planSchedule(classes, badIvals=(), curCRNs=(), verbose=False):
     Sections that take place during intervals in badIvals are not considered.
     Sections that are closed are also not considered, unless their CRN is in
     `curCRNs` (sequence of ints).
+
+    A section whose CRN is in `lockCRNs` is always taken, whatever its status
+    and times, so its type has no other options and sections conflicting with
+    it are dropped before searching.
+
+    The search gives up with BudgetExceeded after `timeLimit` seconds or
+    `nodeLimit` sections tried, if given.
+
+    If `processes` is given, the search is split over that many worker
+    processes (see solver.solveParallel()), and `nodeLimit` applies to each
+    part of the split.
+
+    `prevCRNs` are the CRNs of a previous schedule for a similar request, such
+    as before a class was added. It is reused as much as possible, so only
+    the sections it doesn't cover or that no longer fit are searched for (see
+    solver.repair()), and `processes` is ignored. `nodeLimit` then applies to
+    each of the repair's attempts.
+
+    If given, `stats` (an ObjectDict(int)) is filled with solver counters,
+    and the sections are taken from `sectionsByClass` (see loadSections())
+    instead of fetched.
     """
-    def printV(*args):
-        if verbose:
-            print ' '.join(str(a) for a in args)
+    printV = printer(verbose)
+    if stats is None:
+        stats = ObjectDict(int)
 
-    # Contains lists of mutually exclusive sections - a schedule is made by
-    # selecting one item out of each list.
-    secClusters = []
+    groups, clusters, neighbors = buildClusters(classes, badIvals, curCRNs,
+            verbose, stats, lockCRNs, sectionsByClass)
 
-    for cls in classes:
-        printV('finding sections for', cls)
-        sections = getClassSections(*cls)
-        printV('done')
-
-        for sec in sections:
-            # replace Time and Days with Intervals attribute
-            sec['Intervals'] = sectionToIntervals(sec)
-            del sec['Time']
-            del sec['Days']
-
-            # delete some other stuff so it prints nicer for debugging
-            del sec['Detail']
-            del sec['Instructor']
-            del sec['Location']
-
-            # add class
-            sec['Class'] = cls
-
-        tpToSecList = categorize(sections, key=lambda sec: sec['Type'])
-
-        # filter each section list by if closed and if overlap with badIvals
-        for tp, secs in tpToSecList.iteritems():
-            tpToSecList[tp] = [sec for sec in secs \
-                    if not any(overlaps(secInter, badIval) \
-                            for secInter in sec['Intervals'] \
-                            for badIval in badIvals) \
-                        and (int(sec['CRN']) in curCRNs or 'closed' not in sec['Status'])]
-
-        # check for any categories with no sections open
-        for tp, secs in tpToSecList.iteritems():
-            if not secs:
-                raise Exception('No sections available for %s, %s' \
-                        % (str(cls), tp))
-
-        secClusters += tpToSecList.values()
+    # the group each cluster had in the previous schedule, if any
+    hint = {}
+    prevCRNs = set(int(crn) for crn in prevCRNs)
+    for i, cluster in enumerate(clusters):
+        for g in cluster:
+            if any(sec.crn in prevCRNs for sec in groups[g]):
+                hint[i] = g
+                break
 
     printV('calculating schedule')
-    sectionsToTake = utils.oneFromEach(secClusters, lambda sec1, sec2: any(overlaps(i1, i2) for i1 in sec1['Intervals'] for i2 in sec2['Intervals']))
-    printV('done')
+    deadline, maxNodes = searchLimits(timeLimit, nodeLimit)
+    if hint:
+        chosen = solver.repair(clusters, neighbors, hint, stats, deadline,
+                maxNodes)
+    elif processes:
+        chosen = solver.solveParallel(clusters, neighbors, processes, stats,
+                deadline, maxNodes)
+    else:
+        chosen = solver.solve(clusters, neighbors, stats, deadline, maxNodes)
+    printV('done,', stats.nodes, 'nodes,', stats.backtracks, 'backtracks')
     printV()
+    if chosen is None:
+        if stats.budgetExceeded:
+            raise BudgetExceeded('Search budget exceeded for %s' % str(classes))
+        raise Exception('No schedule possible for %s' % str(classes))
+
+    return expandSchedule(groups, chosen, set(curCRNs) | prevCRNs)
+
+# sections shared with the worker processes of planSchedules()
+_sharedSections = None
+_sharedDeadline = None
+
+def _initPlanWorker(sectionsByClass, deadline):
+    global _sharedSections, _sharedDeadline
+    _sharedSections = sectionsByClass
+    _sharedDeadline = deadline
+
+def _planRequest(sectionsByClass, request, deadline=None):
+    try:
+        if deadline is not None:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                raise BudgetExceeded('Batch time limit reached before %s'
+                        % request['classes'])
+            request = dict(request, timeLimit=min(
+                    request.get('timeLimit') or remaining, remaining))
+        return planSchedule(sectionsByClass=sectionsByClass, **request), None
+    except Exception as err:
+        return None, err
+
+def _planTask(request):
+    return _planRequest(_sharedSections, request, _sharedDeadline)
+
+def planSchedules(requests, processes=None, verbose=False, deadline=None,
+        **kwargs):
+    """
+    Lazily yield (clsToSections, error) for each of `requests`, in order, where
+    clsToSections is what planSchedule() returns, or None if it raised
+    `error`.
+
+    Each request is a dict of planSchedule() keyword arguments, such as
+    classes, badIvals, curCRNs, prevCRNs and lockCRNs, and `kwargs` (such as
+    timeLimit and nodeLimit) are passed with every request. The sections of
+    each distinct class are fetched and converted once for all requests.
+
+    If `processes` is given, requests are solved that many at a time by
+    worker processes.
+
+    If given, `deadline` is a time.time() by which all requests must be done:
+    each one's time limit is cut to the time left, and ones not started by
+    then fail with BudgetExceeded.
+    """
+    requests = [dict(kwargs, **request) for request in requests]
+    sectionsByClass = loadSections(
+            [cls for request in requests for cls in request['classes']],
+            verbose)
+    for request in requests:
+        request['classes'] = [tuple(cls) for cls in request['classes']]
+
+    if not processes:
+        for request in requests:
+            yield _planRequest(sectionsByClass, request, deadline)
+        return
+
+    # only imported when used, since App Engine doesn't provide it
+    import multiprocessing
+
+    pool = multiprocessing.Pool(processes, _initPlanWorker,
+            (sectionsByClass, deadline))
+    try:
+        for result in pool.imap(_planTask, requests):
+            yield result
+    finally:
+        pool.terminate()
+
+def bestSchedules(classes, badIvals=(), curCRNs=(), k=5, objective=None,
+        verbose=False, stats=None, timeLimit=None, nodeLimit=None,
+        processes=None, lockCRNs=()):
+    """
+    Return a list of up to `k` (score, schedule) pairs with the lowest scores,
+    best first, where schedule is a map like planSchedule() returns.
+
+    `objective` is a (score, bound) pair like scheduleObjective() returns, and
+    defaults to scheduleObjective().
+
+    If the search runs out of `timeLimit` or `nodeLimit` (see planSchedule()),
+    the best schedules found so far are returned and stats.budgetExceeded is
+    set, or BudgetExceeded is raised if there are none. `processes` and
+    `lockCRNs` are like for planSchedule().
+    """
+    printV = printer(verbose)
+    if stats is None:
+        stats = ObjectDict(int)
+    if objective is None:
+        objective = scheduleObjective()
+    score, bound = objective
+
+    groups, clusters, neighbors = buildClusters(classes, badIvals, curCRNs,
+            verbose, stats, lockCRNs)
+    masks = [group[0].mask for group in groups]
 
-    clsToSections = categorize(sectionsToTake, key=lambda sec: sec['Class'])
+    printV('calculating best schedules')
+    deadline, maxNodes = searchLimits(timeLimit, nodeLimit)
+    if processes:
+        best = solver.bestSolutionsParallel(clusters, neighbors, masks, score,
+                bound, k, processes, stats, deadline, maxNodes)
+    else:
+        best = solver.bestSolutions(clusters, neighbors, masks, score, bound, k,
+                stats, deadline, maxNodes)
+    printV('done')
+    if not best and stats.budgetExceeded:
+        raise BudgetExceeded('Search budget exceeded for %s' % str(classes))
+    return [(s, expandSchedule(groups, chosen, curCRNs)) for s, chosen in best]
+
+def iterSchedules(classes, badIvals=(), curCRNs=(), after=None, verbose=False,
+        stats=None, timeLimit=None, nodeLimit=None, lockCRNs=()):
+    """
+    Lazily yield (schedule, position) for every possible schedule, where
+    schedule is a map like planSchedule() returns, and schedules differ in the
+    times of at least one section.
+
+    Passing `position` back as `after`, with the same other arguments, resumes
+    the enumeration right after that schedule. It starts with a digest of the
+    request and the sections searched, so one from another request, or from
+    before the sections changed, raises ValueError instead of resuming at an
+    unrelated schedule.
+
+    The enumeration just stops if it runs out of `timeLimit` or `nodeLimit`
+    (see planSchedule()), with stats.budgetExceeded set. `lockCRNs` is like
+    for planSchedule().
+    """
+    groups, clusters, neighbors = buildClusters(classes, badIvals, curCRNs,
+            verbose, stats, lockCRNs)
+    # without requestKey()'s catalog version, which is only this process's
+    digest = hashlib.sha1(repr((
+            requestKey(classes, badIvals, curCRNs, lockCRNs=lockCRNs)[1:],
+            [[sec.crn for sec in group] for group in groups]))).hexdigest()[:16]
+    if after is not None:
+        if not after or after[0] != digest:
+            raise ValueError('Position is from another request or sections')
+        after = after[1:]
+    deadline, maxNodes = searchLimits(timeLimit, nodeLimit)
+    for chosen, position in solver.iterSolutions(clusters, neighbors, stats,
+            after, deadline=deadline, maxNodes=maxNodes):
+        yield expandSchedule(groups, chosen, curCRNs), (digest,) + position
+
+def countSchedules(classes, badIvals=(), curCRNs=(), verbose=False, stats=None,
+        timeLimit=None, nodeLimit=None, lockCRNs=()):
+    """
+    Return (times, sections): the number of possible schedules that differ in
+    the times of at least one section, like iterSchedules() yields, and the
+    number that differ in at least one CRN.
+
+    Raises BudgetExceeded if counting runs out of `timeLimit` or `nodeLimit`
+    (see planSchedule()). `lockCRNs` is like for planSchedule().
+    """
+    printV = printer(verbose)
+    if stats is None:
+        stats = ObjectDict(int)
+
+    groups, clusters, neighbors = buildClusters(classes, badIvals, curCRNs,
+            verbose, stats, lockCRNs)
+
+    printV('counting schedules')
+    deadline, maxNodes = searchLimits(timeLimit, nodeLimit)
+    times = solver.countSolutions(clusters, neighbors, stats=stats,
+            deadline=deadline, maxNodes=maxNodes)
+    if times is not None:
+        sizes = dict((i, len(group)) for i, group in enumerate(groups))
+        sections = solver.countSolutions(clusters, neighbors, sizes, stats,
+                deadline, maxNodes)
+    printV('done')
+    if times is None or sections is None:
+        raise BudgetExceeded('Search budget exceeded for %s' % str(classes))
+    return times, sections
+
+def newCatalog():
+    """Invalidate cached results, after a new catalog has been installed."""
+    global catalogVersion
+    catalogVersion += 1
+    resultCache.clear()
+
+def requestKey(classes, badIvals=(), curCRNs=(), prevCRNs=(), lockCRNs=()):
+    """
+    Return a hashable key that is the same for all schedule requests that are
+    bound to give the same answer with the current catalog.
+
+    >>> cs, ece = ('CS', 125, 2012, 'fall'), ('ECE', 110, 2012, 'fall')
+    >>> key = requestKey([cs, ece], strToIntervals('M 8 9'), [2, 1])
+    >>> key == requestKey([ece, cs],
+    ...         strToIntervals('M 8 8:30') + strToIntervals('M 8:30 9'), [1, 2, 1])
+    True
+    """
+    return (catalogVersion,
+            tuple(sorted(set(tuple(cls) for cls in classes))),
+            # the mask is the same for any set of intervals covering the same
+            # times
+            intervalsToMask(badIvals),
+            tuple(sorted(set(int(crn) for crn in curCRNs))),
+            tuple(sorted(set(int(crn) for crn in prevCRNs))),
+            tuple(sorted(set(int(crn) for crn in lockCRNs))))
+
+def cachedPlanSchedule(classes, badIvals=(), curCRNs=(), prevCRNs=(),
+        lockCRNs=(), **kwargs):
+    """
+    Same as planSchedule(), but answered from resultCache for requests
+    repeated within SECTIONS_FRESH_TTL, so cached schedules are no staler
+    than the sections they're planned from. Only successful results are
+    cached.
+    """
+    key = requestKey(classes, badIvals, curCRNs, prevCRNs, lockCRNs)
+    clsToSections = resultCache.get(key)
+    if clsToSections is None:
+        clsToSections = planSchedule(classes, badIvals, curCRNs,
+                prevCRNs=prevCRNs, lockCRNs=lockCRNs, **kwargs)
+        resultCache[key] = clsToSections
     return clsToSections
 
 if __name__ == '__main__':
@@ -233,9 +1016,9 @@ if __name__ == '__main__':
     for cls, secs in clsToSections.iteritems():
         print '*** %s %s' % cls[:2]
         for sec in secs:
-            print '  -', sec['Type']
-            print '    CRN:', sec['CRN']
+            print '  -', sec.type
+            print '    CRN:', sec.crn
             print '    Times:'
-            for ival in sec['Intervals']:
+            for ival in sec.intervals:
                 print '      ', reprInterval(ival)
             print
@@ -1,13 +1,41 @@
 #!/usr/bin/env python
 import logging
 import json
+import base64
+import itertools
+import time
 
 import webapp2
+from google.appengine.api import memcache
+from google.appengine.api import taskqueue
 import courses
 import misc
+from objdict import ObjectDict
 
 DEBUG = False
 
+# budget for each /solve search, so one pathological request can't tie up the
+# instance
+SOLVE_TIME_LIMIT = 5
+SOLVE_NODE_LIMIT = 500000
+# worker processes for each /solve search; App Engine doesn't allow
+# multiprocessing, but self-hosted deployments can set this to their core count
+SOLVE_PROCESSES = None
+# worker processes solving the requests of each /batch in parallel, for the
+# same deployments
+BATCH_PROCESSES = None
+# seconds all the requests of a /batch may take, within App Engine's request
+# deadline; ones left when it runs out get 'budget exceeded'
+BATCH_TIME_LIMIT = 45
+# scheduleObjective() arguments that /solve takes as weights for best
+OBJECTIVE_WEIGHTS = ('gaps', 'days', 'early')
+# subject pages downloaded at a time by /update, and section pages by each of
+# the /update/sections tasks it queues
+UPDATE_WORKERS = 8
+
+# sections crawled by /update/sections tasks serve every instance
+courses.sharedRows = memcache
+
 subCodeToClasses = None
 year = None
 season = None
@@ -36,6 +64,94 @@ def parseJSInterval(times, dayBools):
 
     return [(day,) + startTime + endTime for day in days]
 
+def parseScheduleRequest(get):
+    """
+    Return (classes, badIvals, curCRNs, prevCRNs, lockCRNs) for a /solve
+    request, where get(name, default) returns its decoded field `name`.
+    """
+    # array of time strings: "08:00 AM"
+    bannedTimes = get('bannedTimes', [])
+    # array of all bannedDays checkboxes (booleans)
+    bannedDays = get('bannedDays', [])
+
+    badIvals = []
+    # each 2 time strings corresponds to 5 bannedDays checkboxes
+    for dayBools, times in zip(misc.iterGroups(bannedDays, 5), misc.iterGroups(bannedTimes, 2)):
+        badIvals += parseJSInterval(times, dayBools)
+
+    subCodes = get('subCodes', [])
+    nums = get('nums', [])
+    curCRNs = get('curCRNs', [])
+    # CRNs of the schedule shown before this request, to start from
+    prevCRNs = get('prevCRNs', [])
+    # pinned sections that must be in the schedule
+    lockCRNs = get('lockCRNs', [])
+
+    classes = [t + (year, season) for t in zip(subCodes, nums)]
+    return classes, badIvals, curCRNs, prevCRNs, lockCRNs
+
+def encodeCursor(position):
+    return base64.urlsafe_b64encode(json.dumps(position))
+
+def decodeCursor(cursor):
+    position = json.loads(base64.urlsafe_b64decode(str(cursor)))
+    if not isinstance(position, list) or not position \
+            or not isinstance(position[0], basestring):
+        raise ValueError('Invalid cursor')
+    return (str(position[0]),) + tuple(int(i) for i in position[1:])
+
+# table columns of sections that aren't sent with schedules
+HIDDEN_FIELDS = ('Time', 'Days', 'Detail', 'Instructor', 'Location')
+
+def sectionToJSON(sec):
+    """Return the JSON-ready form of a courses.Section in a schedule."""
+    out = dict((k, v) for k, v in sec.row.iteritems() if k not in HIDDEN_FIELDS)
+    out['Intervals'] = [courses.reprInterval(i) for i in sec.intervals]
+    out['Class'] = sec.cls
+    out['Alternates'] = [str(crn) for crn in sec.alternates]
+    return out
+
+def scheduleToJSON(clsToSections):
+    """
+    Return the JSON-ready form of a planSchedule() map, keyed by "SUBJ NUM".
+    """
+    out = {}
+    for cls, sections in clsToSections.iteritems():
+        out[cls[0] + ' ' + str(cls[1])] = [sectionToJSON(sec) for sec in sections]
+    return out
+
+def errorToJSON(err):
+    """Return the JSON-ready /solve response for an exception from courses."""
+    if isinstance(err, courses.BudgetExceeded):
+        status = 'budget exceeded'
+    else:
+        status = 'error'
+    return {'status': status, 'error': str(err)}
+
+def parseWeights(field):
+    """
+    Return the scheduleObjective() keyword arguments for the JSON `weights`
+    of a /solve request, an object of numbers keyed by gaps, days and early,
+    or raise ValueError.
+    """
+    weights = json.loads(field or '{}')
+    if not isinstance(weights, dict):
+        raise ValueError('Weights must be an object')
+    unknown = set(weights) - set(OBJECTIVE_WEIGHTS)
+    if unknown:
+        raise ValueError('Unknown weights: %s' % ', '.join(sorted(unknown)))
+    for name, weight in weights.iteritems():
+        if isinstance(weight, bool) or not isinstance(weight, (int, long, float)):
+            raise ValueError('Weight %s must be a number' % name)
+    return dict((str(k), v) for k, v in weights.iteritems())
+
+def parsePositiveInt(field, name):
+    """Return the positive int in request field `name`, or raise ValueError."""
+    value = int(field)
+    if value < 1:
+        raise ValueError('%s must be at least 1' % name)
+    return value
+
 class Update(webapp2.RequestHandler):
     def get(self):
         global subCodeToClasses
@@ -44,49 +160,195 @@ class Update(webapp2.RequestHandler):
 
         year, season = courses.getCurYearSeason()
         subCodes = courses.getSubCodes(year, season)
-        allClasses = []
-        for code in subCodes:
-            allClasses += courses.getClasses(code, year, season)
+        start = time.time()
+        cacheStats = dict(courses.pageCache.stats)
+        timings = {}
+        allClasses, failed = courses.crawlClasses(subCodes, year, season,
+                UPDATE_WORKERS, timings)
+        logging.info('crawled %d subjects in %.1f s, %d failed: %s',
+                len(subCodes), time.time() - start, len(failed), failed)
+        for code, (fetchSecs, parseSecs) in sorted(timings.iteritems(),
+                key=lambda item: -sum(item[1])):
+            logging.info('%s: fetched in %.2f s, parsed in %.2f s', code,
+                    fetchSecs, parseSecs)
+
+        logging.info('page cache: %s', dict((key, value - cacheStats.get(key, 0))
+                for key, value in courses.pageCache.stats.iteritems()))
+
+        # subjects whose page failed keep their classes from the last update
+        # rather than disappearing until the next one
+        for code in failed:
+            if subCodeToClasses and code in subCodeToClasses:
+                allClasses += subCodeToClasses[code]
 
         subCodeToClasses = courses.categorize(allClasses, lambda cls: cls['Subject Code'])
+        courses.newCatalog()
+
+        # every course's sections, so requests on any instance don't fetch
+        # them, crawled into courses.sharedRows by a task per subject since
+        # the whole catalog takes far longer than one request may run
+        for subCode, classes in subCodeToClasses.iteritems():
+            nums = [int(cls['Number']) for cls in classes
+                    if cls['Number'].isdigit()]
+            if nums:
+                taskqueue.add(url='/update/sections', params={
+                        'subCode': subCode, 'nums': json.dumps(nums),
+                        'year': year, 'season': season})
         if DEBUG:
             self.response.out.write(json.dumps(subCodeToClasses))
 
+class UpdateSections(webapp2.RequestHandler):
+    def post(self):
+        subCode = self.request.get('subCode')
+        classYear = int(self.request.get('year'))
+        classSeason = self.request.get('season')
+        classes = [(subCode, num, classYear, classSeason)
+                for num in json.loads(self.request.get('nums'))]
+
+        start = time.time()
+        timings = {}
+        failed = courses.crawlSections(classes, UPDATE_WORKERS, timings)
+        logging.info('crawled sections of %d %s classes in %.1f s, %d failed: %s',
+                len(classes), subCode, time.time() - start, len(failed), failed)
+        for cls, (fetchSecs, parseSecs) in sorted(timings.iteritems(),
+                key=lambda item: -sum(item[1]))[:5]:
+            logging.info('%s %d: fetched in %.2f s, parsed in %.2f s', cls[0],
+                    cls[1], fetchSecs, parseSecs)
+        logging.info('section store: %d classes, %s', len(courses.sectionStore),
+                dict(courses.sectionStore.stats))
+
 class MainPage(webapp2.RequestHandler):
     def get(self):
         self.response.out.write(open('index.html').read().replace('__subCodeToClasses__', json.dumps(subCodeToClasses)))
 
 class Solve(webapp2.RequestHandler):
     def post(self):
-        # array of time strings: "08:00 AM"
-        bannedTimes = json.loads(self.request.get('bannedTimes'))
-        # array of all bannedDays checkboxes (booleans)
-        bannedDays = json.loads(self.request.get('bannedDays'))
+        def get(name, default):
+            field = self.request.get(name)
+            return json.loads(field) if field else default
+        classes, badIvals, curCRNs, prevCRNs, lockCRNs = \
+                parseScheduleRequest(get)
 
-        badIvals = []
-        # each 2 time strings corresponds to 5 bannedDays checkboxes
-        for dayBools, times in zip(misc.iterGroups(bannedDays, 5), misc.iterGroups(bannedTimes, 2)):
-            badIvals += parseJSInterval(times, dayBools)
+        limits = {'timeLimit': SOLVE_TIME_LIMIT, 'nodeLimit': SOLVE_NODE_LIMIT}
+        stats = ObjectDict(int)
 
-        subCodes = json.loads(self.request.get('subCodes'))
-        nums = json.loads(self.request.get('nums'))
-        curCRNs = json.loads(self.request.get('curCRNs'))
+        # with best, return that many schedules ranked by gaps, days on campus
+        # and early starts; weights is an optional object of
+        # scheduleObjective() keyword arguments
+        best = self.request.get('best')
+        if best:
+            try:
+                k = parsePositiveInt(best, 'best')
+                objective = courses.scheduleObjective(
+                        **parseWeights(self.request.get('weights')))
+                ranked = courses.bestSchedules(classes, badIvals, curCRNs,
+                        k, objective, stats=stats,
+                        processes=SOLVE_PROCESSES, lockCRNs=lockCRNs, **limits)
+            except Exception as err:
+                self.response.out.write(json.dumps(errorToJSON(err)))
+                return
+            self.response.out.write(json.dumps({
+                'status': 'budget exceeded' if stats.budgetExceeded else 'ok',
+                'schedules': [scheduleToJSON(sched) for score, sched in ranked],
+                'scores': [score for score, sched in ranked],
+                }))
+            return
 
-        classes = [t + (year, season) for t in zip(subCodes, nums)]
+        # with count, return the number of possible schedules, by times and by
+        # CRNs, instead of a schedule
+        if self.request.get('count'):
+            try:
+                times, sections = courses.countSchedules(classes, badIvals,
+                        curCRNs, stats=stats, lockCRNs=lockCRNs, **limits)
+            except Exception as err:
+                self.response.out.write(json.dumps(errorToJSON(err)))
+                return
+            self.response.out.write(json.dumps({
+                'status': 'ok',
+                'count': times,
+                'sections': sections,
+                }))
+            return
+
+        # with pageSize, return that many schedules and a cursor for the next
+        # page instead of just the first schedule
+        pageSize = self.request.get('pageSize')
+        if pageSize:
+            cursor = self.request.get('cursor')
+            schedules = []
+            position = None
+            try:
+                # a malformed cursor is an error like any other
+                after = decodeCursor(cursor) if cursor else None
+                for clsToSections, position in itertools.islice(
+                        courses.iterSchedules(classes, badIvals, curCRNs, after,
+                            stats=stats, lockCRNs=lockCRNs, **limits),
+                        int(pageSize)):
+                    schedules.append(scheduleToJSON(clsToSections))
+            except Exception as err:
+                self.response.out.write(json.dumps(errorToJSON(err)))
+                return
+
+            if len(schedules) == int(pageSize) or stats.budgetExceeded:
+                # resume after the last schedule sent, or retry the same page
+                # if the budget ran out before finding any
+                nextCursor = encodeCursor(position) if position is not None else cursor
+            else:
+                nextCursor = None
+            self.response.out.write(json.dumps({
+                'status': 'budget exceeded' if stats.budgetExceeded else 'ok',
+                'schedules': schedules,
+                'cursor': nextCursor,
+                }))
+            return
 
         try:
-            clsToSections = courses.planSchedule(classes, badIvals, curCRNs)
-        except:
-            self.response.out.write(json.dumps({}))
+            clsToSections = courses.cachedPlanSchedule(classes, badIvals,
+                    curCRNs, prevCRNs, lockCRNs, stats=stats,
+                    processes=SOLVE_PROCESSES, **limits)
+        except Exception as err:
+            self.response.out.write(json.dumps(errorToJSON(err)))
         else:
-            for cls, sections in clsToSections.items():
-                clsToSections[cls[0] + ' ' + str(cls[1])] = sections
-                del clsToSections[cls]
+            self.response.out.write(json.dumps(scheduleToJSON(clsToSections)))
 
-                for sec in sections:
-                    sec['Intervals'] = [courses.reprInterval(i) for i in sec['Intervals']]
+class Batch(webapp2.RequestHandler):
+    def post(self):
+        # the body is a JSON array of requests, each an object with the fields
+        # of a /solve request, decoded; the response has one JSON object per
+        # line for each, in order, with its 'index' and its 'schedule' or the
+        # errorToJSON() fields. App Engine buffers the response, so the lines
+        # all arrive at the end, within BATCH_TIME_LIMIT.
+        deadline = time.time() + BATCH_TIME_LIMIT
+        requests = []
+        # per entry, the error parsing it, if any
+        parseErrors = []
+        for fields in json.loads(self.request.body):
+            try:
+                if not isinstance(fields, dict):
+                    raise ValueError('Request must be an object')
+                classes, badIvals, curCRNs, prevCRNs, lockCRNs = \
+                        parseScheduleRequest(fields.get)
+            except Exception as err:
+                parseErrors.append(err)
+                continue
+            parseErrors.append(None)
+            requests.append({'classes': classes, 'badIvals': badIvals,
+                    'curCRNs': curCRNs, 'prevCRNs': prevCRNs,
+                    'lockCRNs': lockCRNs})
 
-            self.response.out.write(json.dumps(clsToSections))
+        self.response.headers['Content-Type'] = 'application/x-ndjson'
+        results = courses.planSchedules(requests, BATCH_PROCESSES,
+                deadline=deadline, timeLimit=SOLVE_TIME_LIMIT,
+                nodeLimit=SOLVE_NODE_LIMIT)
+        for i, err in enumerate(parseErrors):
+            if err is None:
+                clsToSections, err = next(results)
+            if err is not None:
+                out = errorToJSON(err)
+            else:
+                out = {'status': 'ok', 'schedule': scheduleToJSON(clsToSections)}
+            out['index'] = i
+            self.response.out.write(json.dumps(out) + '\n')
 
 ##class Complete(webapp2.RequestHandler):
 ##    def get(self):
@@ -113,12 +375,16 @@ class Sections(webapp2.RequestHandler):
     def get(self):
         subCode = self.request.get('subCode')
         num = int(self.request.get('num'))
-        self.response.out.write(json.dumps(courses.getClassSections(subCode, num, year, season)))
+        sections = courses.storedSections(subCode, num, year, season)
+        self.response.out.write(json.dumps(
+                sections and [sec.row for sec in sections]))
 
 app = webapp2.WSGIApplication([
             ('/', MainPage),
             ('/solve', Solve),
+            ('/batch', Batch),
             ('/update', Update),
+            ('/update/sections', UpdateSections),
             ('/sections', Sections)
 ##            ('/complete', Complete)
             ], debug=DEBUG)
@@ -0,0 +1,642 @@
+"""
+Search for a way to pick one value out of each of several domains, such that
+no two picked values conflict.
+
+Values are plain hashable ids (planSchedule uses indices into its list of
+candidate sections), and must be distinct across domains. Conflicts are given
+as `neighbors`, where neighbors[v] is the set of values that conflict with v.
+"""
+import heapq
+import time
+
+from objdict import ObjectDict
+
+def clusterGraph(domains, neighbors):
+    """
+    Return a list of sets, where the i-th set holds the indices of the other
+    domains containing a value that conflicts with some value of domains[i].
+
+    >>> clusterGraph([[0, 1], [2], [3]], {0: set([2]), 1: set(), 2: set([0]), 3: set()})
+    [set([1]), set([0]), set([])]
+    """
+    owner = {}
+    for i, dom in enumerate(domains):
+        for v in dom:
+            owner[v] = i
+
+    adjacent = [set() for dom in domains]
+    for i, dom in enumerate(domains):
+        for v in dom:
+            for w in neighbors[v]:
+                j = owner.get(w)
+                if j is not None and j != i:
+                    adjacent[i].add(j)
+                    adjacent[j].add(i)
+    return adjacent
+
+def reduceDomains(domains, neighbors, stats=None):
+    """
+    Return a copy of `domains` with every value removed that conflicts with all
+    the values left in some other domain, since it can't be part of a
+    solution. This is AC-3: removing a value rechecks the domains that might
+    have relied on it, until nothing changes. A domain that ends up empty means
+    there is no solution.
+
+    If given, `stats` (an ObjectDict(int)) gets the number of values removed in
+    `pruned`.
+
+    >>> nbrs = {0: set([2]), 1: set([3]), 2: set([0]), 3: set([1]), 4: set()}
+    >>> reduceDomains([[0, 1], [2], [3, 4]], nbrs)
+    [[1], [2], [4]]
+    >>> [] in reduceDomains([[0], [2], [3, 4]], nbrs)
+    True
+    """
+    if stats is None:
+        stats = ObjectDict(int)
+
+    domains = [list(dom) for dom in domains]
+    adjacent = clusterGraph(domains, neighbors)
+    queue = [(i, j) for i in xrange(len(domains)) for j in adjacent[i]]
+    queued = set(queue)
+
+    while queue:
+        i, j = queue.pop()
+        queued.discard((i, j))
+
+        other = domains[j]
+        kept = [v for v in domains[i] if not neighbors[v].issuperset(other)]
+        if len(kept) == len(domains[i]):
+            continue
+        stats.pruned += len(domains[i]) - len(kept)
+        domains[i] = kept
+        if not kept:
+            break
+
+        for k in adjacent[i]:
+            if k != j and (k, i) not in queued:
+                queue.append((k, i))
+                queued.add((k, i))
+    return domains
+
+def iterSolutions(domains, neighbors, stats=None, after=None, masks=None,
+        prune=None, deadline=None, maxNodes=None):
+    """
+    Yield (solution, position) for every list holding one value of each domain,
+    in order, such that no two of them are neighbors.
+
+    Uses backtracking with forward checking: after each pick, the values that
+    conflict with it are removed from the domains not yet assigned, and a
+    branch is abandoned as soon as one of them is empty. The next domain to
+    assign is the one with the fewest values left, ties going to the one
+    constraining the most unassigned domains. Only the current branch is kept
+    in memory, however many solutions there are, and there is no recursion
+    limit on the number of domains.
+
+    `position` is a tuple of ints; passing it back as `after` (with the same
+    domains and neighbors) resumes the enumeration right after that solution.
+    An `after` that can't be such a position raises ValueError.
+
+    If `masks` (mapping of value -> int) and `prune` are given, a branch is
+    skipped when prune(sure, maybe) is true. `sure` ORs together the masks of
+    the values picked so far and the bits shared by every value left in each
+    unassigned domain, i.e. the bits every solution below the branch will
+    have; `maybe` ORs together the masks of every value left in the unassigned
+    domains, i.e. the only bits such a solution can have beyond `sure`.
+
+    The search stops early once time.time() passes `deadline` or `maxNodes`
+    values have been tried, and adds 1 to stats.budgetExceeded.
+
+    If given, `stats` (an ObjectDict(int)) gets the number of values tried in
+    `nodes`, the number of them that led to no solution in `backtracks`, the
+    number of branches skipped by `prune` in `bounded`, the values forward
+    checking pushed on the trail in `trail`, and the lists built for the
+    solutions, the only ones built after setup, in `lists`.
+
+    >>> nbrs = {0: set([2]), 1: set(), 2: set([0]), 3: set(), 4: set()}
+    >>> sols = list(iterSolutions([[0, 1], [2], [3, 4]], nbrs))
+    >>> [sol for sol, pos in sols]
+    [[1, 2, 3], [1, 2, 4]]
+    >>> [sol for sol, pos in iterSolutions([[0, 1], [2], [3, 4]], nbrs, after=sols[0][1])]
+    [[1, 2, 4]]
+    >>> list(iterSolutions([[0, 1], [2], [3, 4]], nbrs, after=(-1, 0, 0)))
+    Traceback (most recent call last):
+    ValueError: Position (-1, 0, 0) is out of range
+    >>> stats = ObjectDict(int)
+    >>> sols = list(iterSolutions([[0, 1], [2], [3, 4]], nbrs, stats))
+    >>> stats.nodes, stats.trail, stats.lists
+    (4, 1, 2)
+    >>> stats = ObjectDict(int)
+    >>> list(iterSolutions([[0, 1], [2], [3, 4]], nbrs, stats, maxNodes=2))
+    []
+    >>> stats.budgetExceeded
+    1
+    """
+    if stats is None:
+        stats = ObjectDict(int)
+
+    # The search is a loop over an explicit stack rather than recursion. Values
+    # pruned by forward checking are only marked as removed and pushed on a
+    # trail, which is popped to undo them, so domains keep their order and no
+    # lists are built per node.
+    n = len(domains)
+    if not n:
+        yield [], ()
+        return
+
+    adjacent = clusterGraph(domains, neighbors)
+
+    # internally, values are numbered densely so that per-value state can live
+    # in flat lists, and only keep the neighbors that are in other domains
+    values = [v for dom in domains for v in dom]
+    index = dict((v, a) for a, v in enumerate(values))
+    owner = [i for i, dom in enumerate(domains) for v in dom]
+    doms = [[index[v] for v in dom] for dom in domains]
+    nbrs = [[index[w] for w in neighbors[v] if w in index and owner[index[w]] != owner[a]]
+            for a, v in enumerate(values)]
+    vmasks = [masks[v] for v in values] if masks is not None else None
+
+    assignment = [None] * n
+    assigned = [False] * n
+    # values left in each domain, and unassigned domains adjacent to each one
+    count = [len(dom) for dom in domains]
+    degree = [len(adj) for adj in adjacent]
+    removed = [False] * len(values)
+    trail = []
+
+    # per depth: domain assigned, position of its value, trail length before
+    # the value's pruning, solutions found before the value, and mask so far
+    clusterAt = [0] * n
+    posAt = [0] * n
+    markAt = [0] * n
+    foundAt = [0] * n
+    maskAt = [0] * (n + 1)
+    found = nodes = backtracks = bounded = pushed = 0
+    # nodes tried in total, since `nodes` is reset whenever stats is updated
+    tried = 0
+
+    # the position still being resumed, until the search has gone past it
+    resume = tuple(after) if after is not None else None
+    if resume is not None and len(resume) > n:
+        raise ValueError('Position %r is out of range' % (resume,))
+
+    def resumeAt(depth):
+        pos = resume[depth]
+        if not 0 <= pos < len(doms[clusterAt[depth]]):
+            raise ValueError('Position %r is out of range' % (tuple(after),))
+        return pos
+
+    def select():
+        best = bestKey = None
+        for j in xrange(n):
+            if not assigned[j]:
+                key = count[j] * n - degree[j]
+                if best is None or key < bestKey:
+                    best, bestKey = j, key
+        return best
+
+    def unassign(depth):
+        i = clusterAt[depth]
+        mark = markAt[depth]
+        while len(trail) > mark:
+            w = trail.pop()
+            removed[w] = False
+            count[owner[w]] += 1
+        assigned[i] = False
+        for j in adjacent[i]:
+            degree[j] += 1
+
+    def remainingMasks(mask):
+        maybe = 0
+        for j in xrange(n):
+            if not assigned[j]:
+                common = -1
+                for w in doms[j]:
+                    if not removed[w]:
+                        common &= vmasks[w]
+                        maybe |= vmasks[w]
+                mask |= common
+        return mask, maybe
+
+    def flush():
+        # item access skips ObjectDict's Python-level __getattr__
+        stats['nodes'] += nodes
+        stats['backtracks'] += backtracks
+        stats['bounded'] += bounded
+        stats['trail'] += pushed
+
+    depth = 0
+    clusterAt[0] = select()
+    posAt[0] = resumeAt(0) if resume else 0
+
+    while depth >= 0:
+        i = clusterAt[depth]
+        dom = doms[i]
+        pos = posAt[depth]
+        while pos < len(dom) and removed[dom[pos]]:
+            pos += 1
+        if resume is not None and (depth >= len(resume) or pos != resume[depth]):
+            resume = None
+
+        if pos >= len(dom):
+            # out of values here, so go back to the previous domain's next one
+            depth -= 1
+            if depth >= 0:
+                unassign(depth)
+                if found == foundAt[depth]:
+                    backtracks += 1
+                posAt[depth] += 1
+            continue
+
+        if maxNodes is not None and tried >= maxNodes \
+                or deadline is not None and not tried & 0xff \
+                    and time.time() > deadline:
+            stats['budgetExceeded'] += 1
+            break
+
+        posAt[depth] = pos
+        a = dom[pos]
+        nodes += 1
+        tried += 1
+        markAt[depth] = len(trail)
+        foundAt[depth] = found
+        assigned[i] = True
+        for j in adjacent[i]:
+            degree[j] -= 1
+
+        ok = True
+        for w in nbrs[a]:
+            if not removed[w] and not assigned[owner[w]]:
+                removed[w] = True
+                trail.append(w)
+                j = owner[w]
+                count[j] -= 1
+                if not count[j]:
+                    ok = False
+                    break
+        pushed += len(trail) - markAt[depth]
+
+        if ok and vmasks is not None:
+            maskAt[depth + 1] = maskAt[depth] | vmasks[a]
+            if prune is not None and prune(*remainingMasks(maskAt[depth + 1])):
+                bounded += 1
+                ok = False
+
+        if ok:
+            assignment[i] = values[a]
+            if depth + 1 < n:
+                depth += 1
+                clusterAt[depth] = select()
+                posAt[depth] = resumeAt(depth) \
+                        if resume is not None and depth < len(resume) else 0
+                continue
+            if resume is not None:
+                # this is the solution the caller already has
+                resume = None
+            else:
+                found += 1
+                stats['lists'] += 1
+                flush()
+                nodes = backtracks = bounded = pushed = 0
+                yield list(assignment), tuple(posAt)
+        else:
+            resume = None
+
+        unassign(depth)
+        if found == foundAt[depth]:
+            backtracks += 1
+        posAt[depth] += 1
+
+    flush()
+
+def bestSolutions(domains, neighbors, masks, score, bound, k=1, stats=None,
+        deadline=None, maxNodes=None, cutoff=None):
+    """
+    Return a list of up to `k` (score, solution) pairs with the lowest scores,
+    best first, where a solution's score is score(mask) for the OR of its
+    values' masks.
+
+    This is branch and bound: a branch is skipped once `k` solutions are known
+    and bound(sure, maybe) for the bits it is sure to have and the bits it
+    might add (see iterSolutions()) can't beat the worst of them. bound(s, m)
+    must never exceed score(n) for any n holding all of s and nothing outside
+    s | m.
+
+    If the search stops early because of `deadline` or `maxNodes` (see
+    iterSolutions()), the best solutions found so far are returned.
+
+    `cutoff` is for searching parts of one problem concurrently: if given, an
+    object whose `value` is a score that solutions need to beat, which is
+    lowered to the worst of the k best whenever that is lower.
+
+    >>> nbrs = {0: set(), 1: set(), 2: set(), 3: set()}
+    >>> masks = {0: 1, 1: 2, 2: 2, 3: 12}
+    >>> ones = lambda m: bin(m).count('1')
+    >>> bestSolutions([[0, 1], [2, 3]], nbrs, masks, ones, lambda s, m: ones(s), k=2)
+    [(1, [1, 2]), (2, [0, 2])]
+    >>> bestSolutions([[0, 1], [2, 3]], nbrs, masks, ones, lambda s, m: ones(s), k=0)
+    Traceback (most recent call last):
+    ValueError: k must be at least 1
+    """
+    if k < 1:
+        raise ValueError('k must be at least 1')
+    # max-heap of the best k so far, as (-score, solution)
+    best = []
+
+    # trying the values that look best on their own first finds good
+    # solutions early, so more branches get pruned
+    domains = [sorted(dom, key=lambda v: score(masks[v])) for dom in domains]
+
+    def prune(sure, maybe):
+        if cutoff is not None and bound(sure, maybe) >= cutoff.value:
+            return True
+        return len(best) == k and bound(sure, maybe) >= -best[0][0]
+
+    for solution, position in iterSolutions(domains, neighbors, stats,
+            masks=masks, prune=prune, deadline=deadline, maxNodes=maxNodes):
+        mask = 0
+        for v in solution:
+            mask |= masks[v]
+        s = score(mask)
+        if len(best) < k:
+            heapq.heappush(best, (-s, solution))
+        elif s < -best[0][0]:
+            heapq.heapreplace(best, (-s, solution))
+        if cutoff is not None and len(best) == k and -best[0][0] < cutoff.value:
+            cutoff.value = -best[0][0]
+
+    return [(-negScore, solution) for negScore, solution in sorted(best, reverse=True)]
+
+def solve(domains, neighbors, stats=None, deadline=None, maxNodes=None):
+    """
+    Return the first solution found by iterSolutions(), or None if there is no
+    solution or none was found before `deadline` or `maxNodes`.
+
+    >>> nbrs = {0: set([2]), 1: set(), 2: set([0]), 3: set()}
+    >>> solve([[0, 1], [2], [3]], nbrs)
+    [1, 2, 3]
+    >>> print solve([[0], [2], [3]], nbrs)
+    None
+    """
+    for solution, position in iterSolutions(domains, neighbors, stats,
+            deadline=deadline, maxNodes=maxNodes):
+        return solution
+    return None
+
+def countSolutions(domains, neighbors, weights=None, stats=None,
+        deadline=None, maxNodes=None):
+    """
+    Return the number of solutions, without enumerating them. If `weights`
+    (mapping of value -> int) is given, each solution counts as the product of
+    its values' weights.
+
+    Domains that don't constrain each other, even indirectly, are counted
+    separately and the counts multiplied. Within each such component, domains
+    are assigned in a fixed order and the count below each depth is memoized
+    on which later values the assignment so far rules out, since nothing else
+    can change it. Partial schedules that leave the same times free share one
+    count.
+
+    Returns None if it runs out of `deadline` or `maxNodes` (see
+    iterSolutions()). If given, `stats` (an ObjectDict(int)) gets the number
+    of values tried in `nodes`, memoized counts reused in `memoHits` and
+    components in `components`.
+
+    >>> nbrs = {0: set([2]), 1: set(), 2: set([0]), 3: set(), 4: set()}
+    >>> countSolutions([[0, 1], [2], [3, 4]], nbrs)
+    2
+    >>> countSolutions([[0, 1], [2], [3, 4]], nbrs, {0: 1, 1: 3, 2: 1, 3: 2, 4: 1})
+    9
+    """
+    if stats is None:
+        stats = ObjectDict(int)
+
+    adjacent = clusterGraph(domains, neighbors)
+    # nodes tried, and whether the budget ran out
+    tried = [0, False]
+
+    def countComponent(order):
+        n = len(order)
+        # one bit per value, in the order they are assigned, so the later
+        # values a partial solution rules out are one int
+        bit = {}
+        for c in order:
+            for v in domains[c]:
+                bit[v] = 1 << len(bit)
+        conflicts = dict((v, sum(bit[w] for w in neighbors[v] if w in bit))
+                for v in bit)
+        later = [0] * (n + 1)
+        for d in xrange(n - 1, -1, -1):
+            later[d] = later[d + 1] | sum(bit[v] for v in domains[order[d]])
+        memo = {}
+
+        def count(d, blocked):
+            if d == n:
+                return 1
+            key = (d, blocked & later[d])
+            if key in memo:
+                stats.memoHits += 1
+                return memo[key]
+
+            total = 0
+            for v in domains[order[d]]:
+                tried[0] += 1
+                if maxNodes is not None and tried[0] > maxNodes \
+                        or deadline is not None and not tried[0] & 0xff \
+                            and time.time() > deadline:
+                    tried[1] = True
+                if tried[1]:
+                    return 0
+                if blocked & bit[v]:
+                    continue
+                total += (weights[v] if weights is not None else 1) \
+                        * count(d + 1, blocked | conflicts[v])
+            memo[key] = total
+            return total
+
+        return count(0, 0)
+
+    total = 1
+    seen = set()
+    for start in sorted(xrange(len(domains)), key=lambda i: -len(domains[i])):
+        if start in seen:
+            continue
+        # grow the component from its largest domain, always adding the
+        # largest domain next to the ones so far: the deeper levels, which are
+        # visited most, then have the fewest values and the most shared counts
+        order = [start]
+        seen.add(start)
+        nextTo = set(adjacent[start])
+        while nextTo:
+            j = max(nextTo, key=lambda i: (len(domains[i]), -i))
+            nextTo.remove(j)
+            seen.add(j)
+            order.append(j)
+            nextTo |= adjacent[j] - seen
+        stats.components += 1
+        total *= countComponent(order)
+        if not total or tried[1]:
+            break
+
+    stats.nodes += tried[0]
+    if tried[1]:
+        stats.budgetExceeded += 1
+        return None
+    return total
+
+def repair(domains, neighbors, hint, stats=None, deadline=None, maxNodes=None):
+    """
+    Return a solution like solve(), reusing as much of a previous solution as
+    possible. `hint` maps domain index -> the value it had before, for the
+    domains that existed then.
+
+    First only the domains without a hint are searched, with the others fixed
+    to their old values. If that fails, the hinted domains that constrain an
+    unhinted one are freed too, and if that also fails, everything is searched
+    with the old values tried first.
+
+    >>> nbrs = {0: set([2]), 1: set(), 2: set([0]), 3: set(), 4: set()}
+    >>> repair([[0, 1], [3, 4], [2]], nbrs, {0: 0, 1: 4})
+    [1, 4, 2]
+    >>> stats = ObjectDict(int, budgetExceeded=1)
+    >>> repair([[0, 1], [3, 4], [2]], nbrs, {0: 0, 1: 4}, stats)
+    [1, 4, 2]
+    """
+    if stats is None:
+        stats = ObjectDict(int)
+
+    hint = dict((i, v) for i, v in hint.iteritems() if v in domains[i])
+    adjacent = clusterGraph(domains, neighbors)
+    unhinted = set(xrange(len(domains))) - set(hint)
+    nearby = set(i for i in hint if adjacent[i] & unhinted)
+
+    attempts = (
+            [[hint[i]] if i in hint else dom for i, dom in enumerate(domains)],
+            [[hint[i]] if i in hint and i not in nearby else dom
+                for i, dom in enumerate(domains)],
+            [sorted(dom, key=lambda v: v != hint.get(i))
+                for i, dom in enumerate(domains)],
+            )
+    for attempt in attempts:
+        # stats may already count budgets exceeded by earlier searches
+        exceeded = stats.budgetExceeded
+        solution = solve(attempt, neighbors, stats, deadline, maxNodes)
+        if solution is not None or stats.budgetExceeded > exceeded:
+            return solution
+    return None
+
+def splitProblem(domains, neighbors, minParts):
+    """
+    Return a list of prefixes splitting the search into independent parts:
+    each prefix is a tuple of (domain index, value) pairs fixing the smallest
+    domains, with no two values conflicting. Enough domains are fixed to make
+    at least `minParts` prefixes, if possible.
+
+    >>> nbrs = {0: set([2]), 1: set(), 2: set([0]), 3: set(), 4: set()}
+    >>> splitProblem([[0, 1], [2], [3, 4]], nbrs, 1)
+    [()]
+    >>> splitProblem([[0, 1], [2], [3, 4]], nbrs, 3)
+    [((1, 2), (0, 1), (2, 3)), ((1, 2), (0, 1), (2, 4))]
+    """
+    order = sorted(xrange(len(domains)), key=lambda i: len(domains[i]))
+    prefixes = [()]
+    for i in order:
+        if len(prefixes) >= minParts:
+            break
+        prefixes = [prefix + ((i, v),) for prefix in prefixes
+                for v in domains[i]
+                if not any(w in neighbors[v] for j, w in prefix)]
+    return prefixes
+
+# read-only problem data for pool workers, set up once per worker
+_shared = None
+
+def _initWorker(shared):
+    global _shared
+    _shared = shared
+
+def _restrict(domains, prefix):
+    domains = list(domains)
+    for i, v in prefix:
+        domains[i] = [v]
+    return domains
+
+def _solveTask(prefix):
+    domains, neighbors, deadline, maxNodes = _shared
+    stats = ObjectDict(int)
+    solution = solve(_restrict(domains, prefix), neighbors, stats, deadline,
+            maxNodes)
+    return solution, dict(stats)
+
+def _bestTask(prefix):
+    domains, neighbors, masks, score, bound, k, cutoff, deadline, maxNodes = _shared
+    stats = ObjectDict(int)
+    best = bestSolutions(_restrict(domains, prefix), neighbors, masks, score,
+            bound, k, stats, deadline, maxNodes, cutoff)
+    return best, dict(stats)
+
+def _addStats(stats, workerStats):
+    if stats is not None:
+        for key, value in workerStats.iteritems():
+            stats[key] += value
+
+def solveParallel(domains, neighbors, processes=None, stats=None,
+        deadline=None, maxNodes=None):
+    """
+    Same as solve(), but split into parts (see splitProblem()) searched by a
+    pool of `processes` worker processes (default one per CPU). The first
+    solution found wins and the remaining workers are terminated. `maxNodes`
+    applies to each part.
+
+    The problem data is handed to each worker once when the pool starts
+    (copied by fork), and tasks only carry their prefix.
+    """
+    # only imported when used, since App Engine doesn't provide it
+    import multiprocessing
+
+    processes = processes or multiprocessing.cpu_count()
+    prefixes = splitProblem(domains, neighbors, 4 * processes)
+    pool = multiprocessing.Pool(processes, _initWorker,
+            ((domains, neighbors, deadline, maxNodes),))
+    try:
+        for solution, workerStats in pool.imap_unordered(_solveTask, prefixes):
+            _addStats(stats, workerStats)
+            if solution is not None:
+                return solution
+        return None
+    finally:
+        pool.terminate()
+
+def bestSolutionsParallel(domains, neighbors, masks, score, bound, k=1,
+        processes=None, stats=None, deadline=None, maxNodes=None):
+    """
+    Same as bestSolutions(), but split into parts (see splitProblem()) searched
+    by a pool of `processes` worker processes (default one per CPU), whose
+    results are merged. Workers share the lowest score any of them has had to
+    beat, so each part also prunes with what the others have found.
+    `maxNodes` applies to each part.
+
+    `score` and `bound` don't need to be picklable, since the problem data is
+    handed to each worker once when the pool starts (copied by fork).
+    """
+    import multiprocessing
+
+    if k < 1:
+        raise ValueError('k must be at least 1')
+    processes = processes or multiprocessing.cpu_count()
+    prefixes = splitProblem(domains, neighbors, 4 * processes)
+    cutoff = multiprocessing.Value('d', float('inf'))
+    pool = multiprocessing.Pool(processes, _initWorker,
+            ((domains, neighbors, masks, score, bound, k, cutoff, deadline,
+                maxNodes),))
+    try:
+        best = []
+        for partBest, workerStats in pool.imap_unordered(_bestTask, prefixes):
+            _addStats(stats, workerStats)
+            best = sorted(best + partBest)[:k]
+        return best
+    finally:
+        pool.terminate()
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
@@ -1,3 +1,6 @@
+// CRNs of the last schedule shown, so the server can start from it
+var prevCRNs = [];
+
 function sendData() {
     function getVal() {
         return $(this).val();
@@ -8,33 +11,42 @@ function sendData() {
     var subCodes = $('select.subject-code').map(getVal).get();
     var nums = $('select.class-number').map(function() { return parseInt($(this).val()); }).get();
     var crns = $('input[type="checkbox"].section-pick:checked').map(function() { return parseInt($(this).attr('crn')); }).get();
-    var lockCRNs = $('input[type="checkbox"].section-pick:checked').map(function() { return parseInt($(this).attr('crn')); }).get();
+    var lockCRNs = $('input[type="checkbox"].section-lock:checked').map(function() { return parseInt($(this).attr('crn')); }).get();
+
+    var data = {
+        'bannedTimes': JSON.stringify(bannedTimes),
+        'bannedDays': JSON.stringify(bannedDays),
+        'subCodes': JSON.stringify(subCodes),
+        'nums': JSON.stringify(nums),
+        'curCRNs': JSON.stringify(crns),
+        'lockCRNs': JSON.stringify(lockCRNs),
+        'prevCRNs': JSON.stringify(prevCRNs)
+    };
 
     $.post(
             '/solve',
-            {
-                'bannedTimes': JSON.stringify(bannedTimes),
-                'bannedDays': JSON.stringify(bannedDays),
-                'subCodes': JSON.stringify(subCodes),
-                'nums': JSON.stringify(nums),
-                'curCRNs': JSON.stringify(crns),
-                'lockCRNs': JSON.stringify(lockCRNs)
-            },
+            data,
             function(clsToSections) {
                 clsToSections = JSON.parse(clsToSections);
 
                 var output = $('#output');
                 output.html('');
+                prevCRNs = [];
 
-                if ($.isEmptyObject(clsToSections)) {
+                if (clsToSections['status'] === 'budget exceeded') {
+                    output.html('Sorry, that took too long to solve. Try pinning some sections or banning some times.');
+                    clsToSections = {};
+                } else if (clsToSections['error'] || $.isEmptyObject(clsToSections)) {
                     output.html('Sorry, no schedule possible that fits the requirements.');
-                } 
+                    clsToSections = {};
+                }
 
                 for (var cls in clsToSections) {
                     output.append('<b>' + cls + '</b>');
                     var sections = clsToSections[cls];
                     for (var i = 0; i < sections.length; i++) {
                         var sec = sections[i];
+                        prevCRNs.push(parseInt(sec['CRN']));
                         var secDiv = $('<div class="section-out">').appendTo(output).append('- ' + sec['Type']);
                         var infoDiv = $('<div class="info-out">').appendTo(secDiv).append('CRN: ' + sec['CRN'] + '<br>' + 'Times:');
                         var timeDiv = $('<div class="time-out">').appendTo(infoDiv);
@@ -45,6 +57,22 @@ function sendData() {
                 }
 
                 $(':button').text('Submit').attr('disabled', false);
+
+                if (!$.isEmptyObject(clsToSections)) {
+                    showCount(data);
+                }
+            });
+}
+
+function showCount(data) {
+    $.post(
+            '/solve',
+            $.extend({'count': 1}, data),
+            function(result) {
+                result = JSON.parse(result);
+                if (result['status'] === 'ok') {
+                    $('#output').append('<div class="count-out">' + result['count'] + ' possible schedules (' + result['sections'] + ' counting sections with the same times)</div>');
+                }
             });
 }
 
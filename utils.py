@@ -1,39 +1,501 @@
+import urllib
+import hashlib
 import urllib2
+import urlparse
+import httplib
+import socket
+import StringIO
 import logging
+import threading
+import time
+import Queue
+from collections import OrderedDict
+
+from objdict import ObjectDict
+import solver
 
 DEFAULT_USER_AGENT = 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10.6; rv:10.0) Gecko/20100101 Firefox/10.0'
 
-def urlopenUA(url, userAgent=DEFAULT_USER_AGENT, *args, **kwargs):
-    """Same as urllib2.urlopen(), but with option to set user agent."""
-    req = urllib2.Request(
-            url,
-            headers={'User-Agent': userAgent},
-            *args,
-            **kwargs
-            )
+class ConnectionPool(object):
+    """
+    Thread-safe pool of persistent HTTP(S) connections, so repeated requests to
+    a host skip the TCP and TLS handshakes.
+
+    Up to `size` idle connections are kept per host, and ones idle for more
+    than `idleTimeout` seconds are closed rather than reused. Requests beyond
+    that many at a time open extra connections, which are closed afterwards.
+    Connections opened, reused and expired are counted in self.stats.
+    """
+    # statuses whose Location is followed, like urllib2 does
+    REDIRECTS = (301, 302, 303, 307)
+
+    def __init__(self, size=8, idleTimeout=30, timeout=60):
+        self.size = size
+        self.idleTimeout = idleTimeout
+        self.timeout = timeout
+        self.stats = ObjectDict(int)
+        # (scheme, host) -> list of (connection, time it was returned)
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    def _take(self, key):
+        """Return (connection, whether it was used before) for `key`."""
+        now = time.time()
+        with self._lock:
+            idle = self._idle.get(key, [])
+            while idle:
+                conn, since = idle.pop()
+                if now - since <= self.idleTimeout:
+                    self.stats.reused += 1
+                    return conn, True
+                conn.close()
+                self.stats.expired += 1
+            self.stats.opened += 1
+        scheme, host = key
+        if scheme == 'https':
+            return httplib.HTTPSConnection(host, timeout=self.timeout), False
+        return httplib.HTTPConnection(host, timeout=self.timeout), False
+
+    def _give(self, key, conn):
+        with self._lock:
+            idle = self._idle.setdefault(key, [])
+            if len(idle) < self.size:
+                idle.append((conn, time.time()))
+                return
+        conn.close()
+
+    def _fetch(self, key, method, path, data, headers):
+        """Return the response to one request, with its body read."""
+        while True:
+            conn, reused = self._take(key)
+            try:
+                conn.request(method, path, data, headers)
+                response = conn.getresponse()
+                response.body = response.read()
+            except (httplib.HTTPException, socket.error):
+                conn.close()
+                # the server may have dropped a connection that sat idle, so
+                # try once more on a new one
+                if reused:
+                    continue
+                raise
+            if response.will_close:
+                conn.close()
+            else:
+                self._give(key, conn)
+            return response
+
+    def urlopen(self, url, data=None, headers={}, maxRedirects=5):
+        """
+        Same as urllib2.urlopen(), with extra request `headers`, except that
+        304 Not Modified is returned rather than raised.
+        """
+        for i in xrange(maxRedirects + 1):
+            scheme, host, path, query, fragment = urlparse.urlsplit(url)
+            path = urlparse.urlunsplit(('', '', path or '/', query, ''))
+            response = self._fetch((scheme, host),
+                    'GET' if data is None else 'POST', path, data, headers)
+            location = response.getheader('location')
+            if response.status not in self.REDIRECTS or not location:
+                break
+            url = urlparse.urljoin(url, location)
+            if response.status != 307:
+                data = None
+
+        if response.status >= 400:
+            raise urllib2.HTTPError(url, response.status, response.reason,
+                    response.msg, StringIO.StringIO(response.body))
+        return urllib.addinfourl(StringIO.StringIO(response.body),
+                response.msg, url, response.status)
+
+    def clear(self):
+        """Close all idle connections."""
+        with self._lock:
+            for idle in self._idle.itervalues():
+                for conn, since in idle:
+                    conn.close()
+            self._idle.clear()
+
+# used by urlopenUA(); its size and idleTimeout can be changed at any time
+connectionPool = ConnectionPool()
+
+def urlopenUA(url, userAgent=DEFAULT_USER_AGENT, data=None, headers={}):
+    """
+    Same as urllib2.urlopen(), but with option to set user agent and other
+    request headers, and reusing connections from connectionPool.
+    """
+    headers = dict(headers)
+    headers['User-Agent'] = userAgent
     logging.info(url)
-    return urllib2.urlopen(req)
+    return connectionPool.urlopen(url, data, headers)
+
+class TTLCache(object):
+    """
+    Thread-safe cache of up to `limit` values from load(key), which drops the
+    least recently used one when full.
+
+    A value is returned as is for `fresh` seconds after it is loaded. After
+    that it is still returned, but reloaded in the background, until it is
+    `expire` seconds old and has to be reloaded before it is returned. None
+    is never cached. Counts of 'hits', 'staleHits', 'misses', 'expired',
+    'refreshes', 'refreshErrors' and 'evictions' are kept in self.stats.
+
+    `spawn(func)` runs func() in the background, by default in a new daemon
+    thread.
+
+    >>> now = [0]
+    >>> cache = TTLCache(lambda key: '%s at %d' % (key, now[0]), 10, 60,
+    ...         spawn=lambda func: func())
+    >>> cache.time = lambda: now[0]
+    >>> cache.get('a')
+    'a at 0'
+    >>> now[0] = 20
+    >>> cache.get('a'), cache.get('a')
+    ('a at 0', 'a at 20')
+    >>> now[0] = 100
+    >>> cache.get('a')
+    'a at 100'
+    >>> sorted(cache.stats.items())
+    [('expired', 1), ('hits', 1), ('misses', 1), ('refreshes', 1), ('staleHits', 1)]
+    """
+    def __init__(self, load, fresh, expire, limit=1000, spawn=None):
+        self.load = load
+        self.fresh = fresh
+        self.expire = expire
+        self.limit = limit
+        self.spawn = spawn or self._spawnThread
+        self.time = time.time
+        self.stats = ObjectDict(int)
+        # key -> (value, time loaded)
+        self._items = OrderedDict()
+        # keys being reloaded in the background
+        self._refreshing = set()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _spawnThread(func):
+        thread = threading.Thread(target=func)
+        thread.daemon = True
+        thread.start()
+
+    def get(self, key):
+        now = self.time()
+        with self._lock:
+            entry = self._items.pop(key, None)
+            if entry is None:
+                self.stats.misses += 1
+            else:
+                self._items[key] = entry
+                value, loaded = entry
+                if now - loaded < self.fresh:
+                    self.stats.hits += 1
+                    return value
+                if now - loaded >= self.expire:
+                    self.stats.expired += 1
+                    entry = None
+                else:
+                    self.stats.staleHits += 1
+                    refresh = key not in self._refreshing
+                    self._refreshing.add(key)
+
+        if entry is not None:
+            # outside the lock, since spawn() may run the refresh right away
+            if refresh:
+                self.spawn(lambda: self._refresh(key))
+            return value
+
+        value = self.load(key)
+        if value is not None:
+            self[key] = value
+        return value
+
+    def _refresh(self, key):
+        try:
+            value = self.load(key)
+        except Exception:
+            value = None
+        with self._lock:
+            self._refreshing.discard(key)
+            if value is None:
+                self.stats.refreshErrors += 1
+            else:
+                self.stats.refreshes += 1
+        if value is not None:
+            self[key] = value
+
+    def __setitem__(self, key, value):
+        with self._lock:
+            self._items.pop(key, None)
+            self._items[key] = (value, self.time())
+            while len(self._items) > self.limit:
+                self._items.popitem(last=False)
+                self.stats.evictions += 1
+
+    def __contains__(self, key):
+        """Whether `key` has a value that can be returned without loading."""
+        entry = self._items.get(key)
+        return entry is not None and self.time() - entry[1] < self.expire
 
-def oneFromEach(lists, conflicts):
+    def __len__(self):
+        return len(self._items)
+
+class PageCache(object):
+    """
+    HTTP cache of parsed pages, revalidated with If-None-Match and
+    If-Modified-Since on every fetch, so an unchanged page costs a 304 rather
+    than a download, and isn't parsed again either.
+
+    Bodies aren't kept: an entry holds the page's validators, size and SHA-1
+    digest, and the results of parsing it. A downloaded body is only held
+    until parse() uses it, and one with the same digest as before keeps the
+    results of the last.
+
+    Entries live in `store`, any mapping with get() and item assignment, such
+    as a dict or the default LRUCache. self.stats counts 'requests', 304
+    'hits', 'bytesFetched', 'bytesSaved' by hits, and 'parses' and
+    'parseHits'.
+
+    >>> class Response(object):
+    ...     def __init__(self, code, body=''): self.code, self.body = code, body
+    ...     def getcode(self): return self.code
+    ...     def read(self): return self.body
+    ...     def info(self): return Headers({'etag': '"1"'})
+    >>> class Headers(dict):
+    ...     def getheader(self, name): return self.get(name)
+    >>> responses = [Response(200, 'a b'), Response(304), Response(200, 'a b')]
+    >>> cache = PageCache(urlopen=lambda url, headers: responses.pop(0))
+    >>> def words(body): return body.split()
+    >>> cache.fetch('url'), cache.parse('url', words)
+    (True, ['a', 'b'])
+    >>> cache.store.get('url')['body'] is None
+    True
+    >>> cache.fetch('url'), cache.parse('url', words)
+    (False, ['a', 'b'])
+    >>> cache.fetch('url'), cache.parse('url', words)
+    (True, ['a', 'b'])
+    >>> sorted(cache.stats.items())
+    [('bytesFetched', 6), ('bytesSaved', 3), ('hits', 1), ('parseHits', 2), ('parses', 1), ('requests', 3)]
     """
+    def __init__(self, store=None, urlopen=None):
+        self.store = store if store is not None else LRUCache(5000)
+        # late binding, so tests can replace urlopenUA()
+        self.urlopen = urlopen or (lambda *args, **kwargs:
+                urlopenUA(*args, **kwargs))
+        self.stats = ObjectDict(int)
+        self._lock = threading.Lock()
+
+    def _count(self, **counts):
+        with self._lock:
+            for key, value in counts.iteritems():
+                self.stats[key] += value
+
+    def fetch(self, url):
+        """
+        Download `url` for parse() unless a 304 confirms it hasn't changed,
+        and return whether it was downloaded.
+        """
+        return self._fetch(url, self.store.get(url))[1] is not None
+
+    def _fetch(self, url, entry):
+        """
+        Return (entry, body) for fetch(), revalidating `entry` if any, where
+        body is None if a 304 confirmed it.
+        """
+        headers = {}
+        if entry is not None:
+            if entry['etag']:
+                headers['If-None-Match'] = entry['etag']
+            if entry['lastModified']:
+                headers['If-Modified-Since'] = entry['lastModified']
+
+        response = self.urlopen(url, headers=headers)
+        if response.getcode() == 304 and entry is not None:
+            self._count(requests=1, hits=1, bytesSaved=entry['size'])
+            return entry, None
+
+        body = response.read()
+        self._count(requests=1, bytesFetched=len(body))
+        info = response.info()
+        digest = hashlib.sha1(body).hexdigest()
+        entry = self.store[url] = {
+                'etag': info.getheader('etag'),
+                'lastModified': info.getheader('last-modified'),
+                'size': len(body),
+                'digest': digest,
+                # until parse() uses it
+                'body': body,
+                # parser name -> result
+                'parsed': entry['parsed'] if entry is not None
+                    and entry['digest'] == digest else {},
+                }
+        return entry, body
+
+    def parse(self, url, parser):
+        """
+        Return parser(body) for the last body fetched from `url`, reusing the
+        result from the last time `parser` parsed the same body. The result is
+        shared, so it must not be modified.
+        """
+        name = parser.__name__
+        # crawl and request threads share entries, so the body is taken under
+        # the lock, along with the check that it still needs parsing
+        with self._lock:
+            entry = self.store.get(url)
+            body = entry and entry['body']
+            if entry is not None and name in entry['parsed']:
+                entry['body'] = None
+                self.stats.parseHits += 1
+                return entry['parsed'][name]
+        if body is None:
+            # dropped from the store since it was fetched, or its body is gone
+            # and `parser` never saw it
+            entry, body = self._fetch(url, None)
+        result = parser(body)
+        with self._lock:
+            entry['parsed'][name] = result
+            entry['body'] = None
+            self.stats.parses += 1
+        return result
+
+def imapThreaded(func, items, workers=8):
+    """
+    Call func(item) for each of `items` in up to `workers` threads at a time,
+    and lazily yield (item, result, error, seconds) as the calls finish, where
+    `error` is the exception func() raised, if any, and `result` is then None.
+
+    Items not started yet are dropped if the caller stops iterating early.
+
+    >>> sorted((x, r, type(e).__name__) for x, r, e, s in imapThreaded(
+    ...         lambda x: 10 // x, [0, 1, 2], workers=2))
+    [(0, None, 'ZeroDivisionError'), (1, 10, 'NoneType'), (2, 5, 'NoneType')]
+    """
+    items = list(items)
+    todo = Queue.Queue()
+    for item in items:
+        todo.put(item)
+    done = Queue.Queue()
+
+    def work():
+        while True:
+            try:
+                item = todo.get_nowait()
+            except Queue.Empty:
+                return
+            start = time.time()
+            try:
+                result, error = func(item), None
+            except Exception as err:
+                result, error = None, err
+            done.put((item, result, error, time.time() - start))
+
+    for i in xrange(min(workers, len(items))):
+        thread = threading.Thread(target=work)
+        thread.daemon = True
+        thread.start()
+
+    try:
+        for i in xrange(len(items)):
+            yield done.get()
+    finally:
+        # let the workers finish what they're doing and stop
+        while True:
+            try:
+                todo.get_nowait()
+            except Queue.Empty:
+                break
+
+class LRUCache(object):
+    """
+    Thread-safe mapping holding at most `limit` items, which drops the least
+    recently used item when full, and with a `ttl`, items set more than that
+    many seconds ago. Hits and misses of get() are counted in self.stats, and
+    the misses on such old items in 'expired' too.
+
+    >>> cache = LRUCache(2)
+    >>> cache['a'] = 1
+    >>> cache['b'] = 2
+    >>> cache.get('a')
+    1
+    >>> cache['c'] = 3
+    >>> print cache.get('b')
+    None
+    >>> sorted(cache.stats.items())
+    [('hits', 1), ('misses', 1)]
+    >>> now = [0]
+    >>> cache = LRUCache(2, ttl=10)
+    >>> cache.time = lambda: now[0]
+    >>> cache['a'] = 1
+    >>> now[0] = 10
+    >>> print cache.get('a'), len(cache)
+    None 0
+    >>> sorted(cache.stats.items())
+    [('expired', 1), ('misses', 1)]
+    """
+    def __init__(self, limit=1000, ttl=None):
+        self.limit = limit
+        self.ttl = ttl
+        self.time = time.time
+        self.stats = ObjectDict(int)
+        # key -> (value, time set)
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value, stored = self._items.pop(key)
+            except KeyError:
+                self.stats.misses += 1
+                return default
+            if self.ttl is not None and self.time() - stored >= self.ttl:
+                self.stats.misses += 1
+                self.stats.expired += 1
+                return default
+            self._items[key] = (value, stored)
+            self.stats.hits += 1
+            return value
+    def __setitem__(self, key, value):
+        with self._lock:
+            self._items.pop(key, None)
+            self._items[key] = (value, self.time())
+            if len(self._items) > self.limit:
+                self._items.popitem(last=False)
+    def __len__(self):
+        return len(self._items)
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+def oneFromEach(lists, conflicts, stats=None):
+    """
+    Return a list holding one element of each list, in order, such that
+    `conflicts(a, b)` is false for every pair of them, or None if there is no
+    such list. See solver.solve() for the search and `stats`.
+
     >>> print oneFromEach(((1, 2, 3), (5,), (5,)), lambda a, b: a == b)
     None
     >>> print oneFromEach(((1, 5), (5,), (5, 1, 2)), lambda a, b: a == b)
+    [1, 5, 2]
     """
-    def inner(lists, existing=[]):
-        if not lists:
-            return []
-        for e in lists[0]:
-            if not any(conflicts(e, exE) for exE in existing):
-                try:
-                    ans = [e] + inner(lists[1:], existing + [e])
-                except ValueError:
-                    pass
-                else:
-                    return ans
-        raise ValueError('no solution')
+    # the solver wants distinct hashable values, so work on positions
+    elems = [e for l in lists for e in l]
+    owner = [i for i, l in enumerate(lists) for e in l]
+    neighbors = [set() for e in elems]
+    for a in xrange(len(elems)):
+        for b in xrange(a + 1, len(elems)):
+            if owner[a] != owner[b] and conflicts(elems[a], elems[b]):
+                neighbors[a].add(b)
+                neighbors[b].add(a)
+
+    domains = []
+    i = 0
+    for l in lists:
+        domains.append(range(i, i + len(l)))
+        i += len(l)
 
-    return inner(sorted(lists, key=len))
+    ans = solver.solve(domains, neighbors, stats)
+    if ans is None:
+        return None
+    return [elems[a] for a in ans]
 
 if __name__ == '__main__':
     import doctest